@@ -0,0 +1,89 @@
+from quart import Quart, Response, render_template, request
+from results import get_results_async, get_results_json_async, DEFAULT_RESULT_COLUMNS
+from functions import metrics, net
+import gzip
+import json
+
+# Async version of view.py: the requests to Google Maps and the url
+# expansions do not block the event loop and the scoring runs on an
+# executor, so one process serves many queries at once.
+# Run it with an ASGI server, e.g. hypercorn asgi:app
+
+
+app = Quart(__name__)
+
+def json_body(data):
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode("utf-8")
+
+@app.after_serving
+async def close_connections():
+    await net.async_close()
+
+@app.route('/home/', methods=['GET', 'POST'])
+@app.route('/', methods=['GET', 'POST'])
+async def home():
+    if request.method == 'POST':
+        form = await request.form
+        try:
+            with metrics.STAGE_SECONDS.labels(stage="total").time():
+                results = await get_results_async(
+                    input_url = form['maps_url'],
+                    gas = form['gas'],
+                    consumption_per_100km = float(form['consumption']),
+                    liters_to_fill_up = float(form['liters']),
+                    trade_off = float(form['trade_off']),
+                    km_start = float(form['start']),
+                    km_end = float(form['end']),
+                    timer = metrics.stage_timer
+                )
+        except Exception:
+            metrics.REQUESTS.labels(outcome="error").inc()
+            raise
+        metrics.REQUESTS.labels(outcome="ok").inc()
+        return results
+    return await render_template("home.html")
+
+@app.route('/api/results', methods=['GET', 'POST'])
+async def api_results():
+    """Best stations as JSON, see view.api_results."""
+    values = await request.values
+    try:
+        columns = values.get('columns')
+        columns = columns.split(",") if columns else DEFAULT_RESULT_COLUMNS
+        with metrics.STAGE_SECONDS.labels(stage="total").time():
+            results = await get_results_json_async(
+                input_url = values['maps_url'],
+                gas = values['gas'],
+                consumption_per_100km = float(values['consumption']),
+                liters_to_fill_up = float(values['liters']),
+                trade_off = float(values['trade_off']),
+                km_start = float(values.get('start', 0)),
+                km_end = float(values.get('end', 200)),
+                columns = columns,
+                refine = values.get('refine', '1') != '0',
+                timer = metrics.stage_timer
+            )
+        body = json_body(results)
+        status = 200
+        metrics.REQUESTS.labels(outcome="ok").inc()
+    except (KeyError, ValueError) as e:
+        body = json_body({"error": type(e).__name__ + ": " + str(e)})
+        status = 400
+        metrics.REQUESTS.labels(outcome="error").inc()
+    except Exception:
+        metrics.REQUESTS.labels(outcome="error").inc()
+        raise
+
+    response = Response(body, status=status, mimetype="application/json")
+    response.vary.add("Accept-Encoding")
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        response.set_data(gzip.compress(body))
+        response.headers["Content-Encoding"] = "gzip"
+    return response
+
+@app.route('/metrics')
+async def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+if __name__ == "__main__":
+    app.run(debug=True)
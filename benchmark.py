@@ -0,0 +1,360 @@
+"""Benchmark of the get_results pipeline without calling Google Maps.
+
+The directions responses of each scenario are replayed from the json files
+of files/benchmark by a stub client, and the stations are read from the
+files/201811170104_*.csv snapshots. Each stage of get_results is timed and
+the medians are compared to files/benchmark/baseline.json.
+
+The baseline durations depend on the machine they were measured on. A
+fixed calibration workload is timed with them, and the baseline is scaled
+by the ratio of its current duration to the saved one before comparing,
+so that a slower or faster machine does not report false regressions or
+hide real ones. The scaling is approximate: save a new baseline with
+--save on the machine running the benchmark when it changes, and after
+any intended change of the timings.
+
+Run it from the parent folder of the package:
+
+    python -m functions.benchmark              # fail on regressions
+    python -m functions.benchmark --save       # store a new baseline
+    python -m functions.benchmark --record     # record responses from the API
+    python -m functions.benchmark --synthesize # generate responses offline
+
+The checked-in responses were generated with --synthesize: routes follow
+the straight line between their points with a road-like detour factor.
+Record real responses with --record when an API key is available.
+"""
+import argparse
+import contextlib
+import json
+import os
+import statistics
+import sys
+import time
+import numpy as np
+import pandas as pd
+import polyline
+from . import config, data, results
+from .geo import exact_distance, exact_distance_arr
+
+FILES_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "files")
+BENCHMARK_FOLDER = os.path.join(FILES_FOLDER, "benchmark")
+BASELINE_JSON = os.path.join(BENCHMARK_FOLDER, "baseline.json")
+SNAPSHOT_DATE = "201811170104"
+
+SCENARIOS = [
+    {"name": "urban",
+     "input_url": "https://www.google.com/maps/dir/48.8532,2.3692/48.8918,2.2362/",
+     "km_end": 200},
+    {"name": "200km",
+     "input_url": "https://www.google.com/maps/dir/48.8566,2.3522/48.0061,0.1996/",
+     "km_end": 200},
+    {"name": "900km",
+     "input_url": "https://www.google.com/maps/dir/50.6292,3.0573/43.2965,5.3698/",
+     "km_end": 1200},
+    {"name": "around_me",
+     "input_url": "45.764,4.8357",
+     "km_end": 200},
+]
+
+SCENARIO_PARAMS = {"gas": 1,
+                   "consumption_per_100km": 6.5,
+                   "liters_to_fill_up": 40,
+                   "trade_off": 5,
+                   "km_start": 0}
+
+
+def load_snapshot_store(date=SNAPSHOT_DATE):
+    """Return a SnapshotStore holding the checked-in csv snapshots.
+
+    The coordinates of these files were saved as the repr of a pandas
+    Series, the number is extracted from it.
+    """
+    store = data.SnapshotStore(FILES_FOLDER, poll_interval=0)
+    snapshots = {}
+    for gas_name in config.GAS_DICT.values():
+        df = pd.read_csv(os.path.join(FILES_FOLDER, date + "_" + gas_name + ".csv"),
+                         encoding="utf-8", dtype={"id": str})
+        for col in ['latitude', 'longitude']:
+            if not pd.api.types.is_numeric_dtype(df[col]):
+                df[col] = pd.to_numeric(df[col].str.extract(r"^\S+\s+(\S+)")[0],
+                                        errors='coerce')
+        snapshots[gas_name] = data.Snapshot(df, date)
+    store.swap(date, snapshots)
+    return store
+
+
+class ReplayClient:
+    """Stub googlemaps client returning recorded directions responses.
+
+    Requests missing from the recording are sent to fallback if given,
+    and counted in misses.
+    """
+
+    def __init__(self, responses, fallback=None):
+        self.responses = responses
+        self.fallback = fallback
+        self.misses = 0
+
+    def directions(self, origin, destination, waypoints=None, alternatives=False):
+        key = data.directions_key(origin, waypoints, destination, alternatives)
+        if key in self.responses:
+            return self.responses[key]
+        if self.fallback is None:
+            raise KeyError("Directions request not recorded: " + key)
+        self.misses += 1
+        return self.fallback.directions(origin=origin,
+                                        destination=destination,
+                                        waypoints=waypoints,
+                                        alternatives=alternatives)
+
+
+class RecordingClient:
+    """Wrap a client and keep its directions responses by request key."""
+
+    def __init__(self, client):
+        self.client = client
+        self.responses = {}
+
+    def directions(self, origin, destination, waypoints=None, alternatives=False):
+        api_result = self.client.directions(origin=origin,
+                                            destination=destination,
+                                            waypoints=waypoints,
+                                            alternatives=alternatives)
+        self.responses[data.directions_key(origin, waypoints, destination,
+                                           alternatives)] = api_result
+        return api_result
+
+
+class SyntheticClient:
+    """Offline client generating directions responses.
+
+    Points are "lat,lng" strings or station waypoints ("Nom, address")
+    found in places. Routes follow straight lines between the points,
+    sampled every step_length m, with a detour factor on distances.
+    """
+
+    detour_factor = 1.3
+    step_length = 500
+    vertices_by_step = 40
+
+    def __init__(self, places):
+        self.places = places
+
+    def _coord(self, point):
+        if point in self.places:
+            return self.places[point]
+        lat, lng = point.split(",")
+        return float(lat), float(lng)
+
+    def _leg(self, start, end):
+        length = exact_distance(*start, *end)
+        nb_pts = max(int(length // self.step_length), 1) + 1
+        lat = np.linspace(start[0], end[0], nb_pts)
+        lng = np.linspace(start[1], end[1], nb_pts)
+        # a small wiggle so that the route is not a single straight segment
+        wiggle = 0.002 * np.sin(np.linspace(0, 20 * np.pi, nb_pts))
+        lat[1:-1] += wiggle[1:-1]
+
+        distance = self.detour_factor * float(np.sum(exact_distance_arr(lat[:-1], lng[:-1],
+                                                                        lat[1:], lng[1:])))
+        speed = 10 if length < 20000 else 25
+
+        steps = []
+        for first in range(0, nb_pts - 1, self.vertices_by_step):
+            last = min(first + self.vertices_by_step, nb_pts - 1)
+            steps.append({
+                "polyline": {"points": polyline.encode(list(zip(lat[first:last + 1],
+                                                                lng[first:last + 1])))},
+                "end_location": {"lat": float(lat[last]), "lng": float(lng[last])}
+            })
+
+        leg = {"start_location": {"lat": float(lat[0]), "lng": float(lng[0])},
+               "end_location": {"lat": float(lat[-1]), "lng": float(lng[-1])},
+               "distance": {"value": int(distance)},
+               "duration": {"value": int(distance / speed)},
+               "steps": steps}
+        return leg, list(zip(lat, lng))
+
+    def directions(self, origin, destination, waypoints=None, alternatives=False):
+        if waypoints is None:
+            waypoints = []
+        elif isinstance(waypoints, str):
+            waypoints = [waypoints]
+
+        points = [self._coord(pt) for pt in [origin] + list(waypoints) + [destination]]
+        legs = []
+        overview = []
+        for start, end in zip(points[:-1], points[1:]):
+            leg, leg_points = self._leg(start, end)
+            legs.append(leg)
+            overview += leg_points[::10] + [leg_points[-1]]
+
+        return [{"legs": legs,
+                 "overview_polyline": {"points": polyline.encode(overview)}}]
+
+
+def station_places(store):
+    """Return the coordinates of the stations by waypoint string."""
+    places = {}
+    for snapshot in store._state[1].values():
+        df = snapshot.df
+        waypoints = df['Nom'].astype(str) + ", " + df['address'].astype(str)
+        places.update(zip(waypoints, zip(df['latitude'].astype(float),
+                                         df['longitude'].astype(float))))
+    return places
+
+
+def scenario_json(scenario):
+    return os.path.join(BENCHMARK_FOLDER, scenario["name"] + ".json")
+
+
+def run_scenario(scenario, client, repeat):
+    """Run get_results repeat times and return the median duration of each stage."""
+    durations = {}
+
+    @contextlib.contextmanager
+    def timer(stage):
+        start = time.perf_counter()
+        yield
+        durations.setdefault(stage, []).append(time.perf_counter() - start)
+
+    previous_client = data._directions_client
+    data._directions_client = client
+    try:
+        for _ in range(repeat):
+            # time the whole pipeline, not the result cache
+            results.result_cache.clear()
+            start = time.perf_counter()
+            results.get_results(input_url=scenario["input_url"],
+                                km_end=scenario["km_end"],
+                                timer=timer,
+                                **SCENARIO_PARAMS)
+            durations.setdefault("total", []).append(time.perf_counter() - start)
+    finally:
+        data._directions_client = previous_client
+
+    return {stage: statistics.median(values) for stage, values in durations.items()}
+
+
+def calibrate(repeat=5):
+    """Return the median duration of a fixed workload, the speed of the machine.
+
+    Like the pipeline, it mixes NumPy computations and Python loops.
+    """
+    rng = np.random.default_rng(0)
+    lat = 43 + 7 * rng.random(200000)
+    lng = -1 + 8 * rng.random(200000)
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        exact_distance_arr(lat[:-1], lng[:-1], lat[1:], lng[1:]).sum()
+        sum(exact_distance(lat[i], lng[i], 48.8566, 2.3522) for i in range(20000))
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def compare(medians, baseline, tolerance, min_regression, scale=1.):
+    """Return the list of (scenario, stage, median, baseline) regressions.
+
+    The baseline durations are multiplied by scale.
+    """
+    regressions = []
+    for name, stages in medians.items():
+        for stage, median in stages.items():
+            reference = baseline.get(name, {}).get(stage)
+            if reference is None:
+                continue
+            reference *= scale
+            if median > reference * (1 + tolerance) and median - reference > min_regression:
+                regressions.append((name, stage, median, reference))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="allowed relative slowdown of a stage")
+    parser.add_argument("--min-regression", type=float, default=0.002,
+                        help="slowdowns below this number of seconds are ignored")
+    parser.add_argument("--save", action="store_true", help="store a new baseline")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--record", action="store_true",
+                      help="record directions responses with the Google Maps API")
+    mode.add_argument("--synthesize", action="store_true",
+                      help="generate directions responses offline")
+    args = parser.parse_args(argv)
+
+    store = load_snapshot_store()
+    previous_store = results.snapshot_store
+    previous_unshorten = results.unshorten_url
+    results.snapshot_store = store
+    # the scenarios use full urls, url expansion is a network call
+    results.unshorten_url = lambda url: url
+
+    try:
+        if args.record or args.synthesize:
+            if args.record:
+                import googlemaps
+                source = googlemaps.Client(key=config.GOOGLE_API_KEY)
+            else:
+                source = SyntheticClient(station_places(store))
+            os.makedirs(BENCHMARK_FOLDER, exist_ok=True)
+            for scenario in SCENARIOS:
+                client = RecordingClient(source)
+                run_scenario(scenario, client, repeat=1)
+                with open(scenario_json(scenario), "w", encoding="utf-8") as f:
+                    json.dump({"source": "google" if args.record else "synthetic",
+                               "responses": client.responses}, f)
+                print(f"{scenario['name']}: {len(client.responses)} responses saved")
+            return 0
+
+        fallback = SyntheticClient(station_places(store))
+        medians = {}
+        # the machine is calibrated along the scenarios, as its speed varies
+        calibrations = []
+        for scenario in SCENARIOS:
+            calibrations.append(calibrate())
+            with open(scenario_json(scenario), encoding="utf-8") as f:
+                client = ReplayClient(json.load(f)["responses"], fallback)
+            medians[scenario["name"]] = run_scenario(scenario, client, args.repeat)
+            if client.misses:
+                print(f"{scenario['name']}: {client.misses} requests were not "
+                      "recorded and were synthesized")
+    finally:
+        results.snapshot_store = previous_store
+        results.unshorten_url = previous_unshorten
+    calibration = statistics.median(calibrations)
+
+    baseline = {}
+    if os.path.exists(BASELINE_JSON):
+        with open(BASELINE_JSON, encoding="utf-8") as f:
+            baseline = json.load(f)
+    scale = 1.
+    if "calibration" in baseline:
+        scale = calibration / baseline["calibration"]
+    print(f"calibration {calibration * 1000:.2f} ms, baseline scaled by {scale:.2f}")
+
+    for name, stages in medians.items():
+        print(name)
+        for stage, median in stages.items():
+            reference = baseline.get(name, {}).get(stage)
+            reference = f"{reference * scale * 1000:10.2f}" if reference is not None else " " * 10
+            print(f"    {stage:<16}{median * 1000:10.2f} ms  baseline {reference} ms")
+
+    if args.save:
+        with open(BASELINE_JSON, "w", encoding="utf-8") as f:
+            json.dump({"calibration": calibration, **medians}, f, indent=2)
+        print("Baseline saved to " + BASELINE_JSON)
+        return 0
+
+    regressions = compare(medians, baseline, args.tolerance, args.min_regression, scale)
+    for name, stage, median, reference in regressions:
+        print(f"Regression in {name}/{stage}: {median * 1000:.2f} ms "
+              f"instead of {reference * 1000:.2f} ms")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """In-memory cache with a time to live and a maximum number of entries.
+
+    Entries older than ttl seconds are ignored, and the least recently used
+    entry is evicted when maxsize is reached. ttl=None keeps entries forever.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                created, value = self._data[key]
+            except KeyError:
+                return default
+            if self.ttl is not None and time.time() - created > self.ttl:
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SqliteCache:
+    """On-disk cache with the same interface as LRUCache.
+
+    Values must be JSON serializable. The cache can be shared by several
+    processes using the same database file.
+    """
+
+    def __init__(self, path, maxsize=100000, ttl=None, table="cache"):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.table = table
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS {table} "
+                               "(key TEXT PRIMARY KEY, value TEXT, "
+                               "created REAL, last_access REAL)")
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_last_access "
+                               f"ON {table} (last_access)")
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(f"SELECT value, created FROM {self.table} "
+                                     "WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return default
+            if self.ttl is not None and now - row[1] > self.ttl:
+                self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                return default
+            self._conn.execute(f"UPDATE {self.table} SET last_access = ? "
+                               "WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(f"INSERT OR REPLACE INTO {self.table} "
+                               "VALUES (?, ?, ?, ?)",
+                               (key, json.dumps(value), now, now))
+            self._conn.execute(f"DELETE FROM {self.table} WHERE key IN "
+                               f"(SELECT key FROM {self.table} "
+                               "ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                               (self.maxsize,))
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute(f"DELETE FROM {self.table}")
@@ -0,0 +1,244 @@
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+# Binary columnar format of the price tables.
+# A table is a folder holding one .npy file per column and a schema.json
+# file describing how to rebuild the columns:
+#   float32  -- coordinates, stored as float32
+#   numeric  -- stored as is (float, int, bool)
+#   datetime -- stored as datetime64[s]
+#   category -- stored as integer codes (-1 for missing values) in
+#               <column>.npy and the categories in <column>.categories.npy
+# Every .npy file can be memory-mapped, so readers load a table without
+# copying it. Files are never modified once written, so the unchanged
+# columns of a new version of a table are hard links to the previous one.
+#
+# The changes of a table since it was written are kept in delta tables,
+# in the same format: <table>_<run>.delta holds the rows added, updated
+# or removed by the run <run>, with a change column, see diff_tables.
+# The deltas are applied in the order of their runs.
+
+TABLE_EXT = ".cols"
+DELTA_EXT = ".delta"
+FLOAT32_COLS = ('latitude', 'longitude')
+
+
+def _column_kind(series, name):
+    if name in FLOAT32_COLS:
+        return "float32"
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return "datetime"
+    if pd.api.types.is_bool_dtype(series) or pd.api.types.is_numeric_dtype(series):
+        return "numeric"
+    return "category"
+
+
+def link_or_copy(src, dst):
+    """Hard link src to dst, or copy it if the file system cannot link it."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _read_schema(path):
+    with open(os.path.join(path, "schema.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _same_array(path, values):
+    if not os.path.exists(path):
+        return False
+    previous = np.load(path, mmap_mode="r", allow_pickle=False)
+    return (previous.dtype == values.dtype
+            and np.array_equal(previous, values,
+                               equal_nan=values.dtype.kind in "fcmM"))
+
+
+def write_table(df, path, previous=None):
+    """Write a DataFrame to path in the binary columnar format.
+
+    The table is written to a temporary folder which is then renamed, so
+    readers never see a partially written table.
+    If previous is the path of another table, the columns identical to
+    its columns are hard linked instead of written.
+    Return the names of the columns written.
+    """
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    previous_kinds = {}
+    if previous is not None and os.path.isdir(previous):
+        previous_kinds = {column['name']: column['kind']
+                          for column in _read_schema(previous)}
+
+    schema = []
+    written = []
+    for name in df.columns:
+        series = df[name]
+        kind = _column_kind(series, name)
+
+        files = {}
+        if kind == "float32":
+            values = pd.to_numeric(series, errors='coerce').to_numpy(dtype=np.float32)
+        elif kind == "datetime":
+            values = series.to_numpy(dtype="datetime64[s]")
+        elif kind == "numeric":
+            values = series.to_numpy()
+        else:
+            categorical = pd.Categorical(series)
+            files[name + ".categories.npy"] = \
+                np.asarray(categorical.categories.astype(str), dtype=str)
+            values = categorical.codes
+        files[name + ".npy"] = np.ascontiguousarray(values)
+
+        if (previous_kinds.get(name) == kind
+                and all(_same_array(os.path.join(previous, file_name), file_values)
+                        for file_name, file_values in files.items())):
+            for file_name in files:
+                link_or_copy(os.path.join(previous, file_name),
+                             os.path.join(tmp_path, file_name))
+        else:
+            for file_name, file_values in files.items():
+                np.save(os.path.join(tmp_path, file_name), file_values,
+                        allow_pickle=False)
+            written.append(name)
+        schema.append({"name": name, "kind": kind})
+
+    with open(os.path.join(tmp_path, "schema.json"), "w", encoding="utf-8") as f:
+        json.dump(schema, f)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    return written
+
+
+def _comparable(series, name):
+    """Return the values of a column as write_table stores them, with the
+    categories decoded and None for missing categories.
+    """
+    kind = _column_kind(series, name)
+    if kind == "float32":
+        return pd.to_numeric(series, errors='coerce').to_numpy(dtype=np.float32)
+    if kind == "datetime":
+        return series.to_numpy(dtype="datetime64[s]")
+    if kind == "numeric":
+        return series.to_numpy()
+    return np.where(series.isna().to_numpy(), None,
+                    series.astype(str).to_numpy(dtype=object))
+
+
+def diff_tables(previous, df, key='id'):
+    """Return the delta table turning the table previous into df.
+
+    Rows are matched on key, which must be unique. The delta has the
+    columns of df and a change column: the rows of df missing from
+    previous are "added", the ones with any value different from their row
+    in previous are "updated", and the rows of previous missing from df
+    are "removed".
+    """
+    previous_keys = pd.Index(previous[key].astype(str))
+    keys = df[key].astype(str)
+    positions = previous_keys.get_indexer(keys)
+    matched = positions >= 0
+
+    changed = ~matched
+    for name in df.columns:
+        if name == key:
+            continue
+        if name not in previous.columns:
+            changed[:] = True
+            break
+        values = _comparable(df[name], name)[matched]
+        previous_values = _comparable(previous[name], name)[positions[matched]]
+        changed[matched] |= ~((values == previous_values)
+                              | (pd.isna(values) & pd.isna(previous_values)))
+
+    delta = df[changed].assign(change=np.where(matched[changed], "updated", "added"))
+    removed = previous[~previous_keys.isin(keys)][list(df.columns)] \
+        .assign(change="removed")
+    return pd.concat([delta, removed], ignore_index=True)
+
+
+def apply_delta(df, delta, key='id'):
+    """Return a copy of df with the changes of a delta table applied.
+
+    The updated rows keep their positions, the removed rows are dropped and
+    the added ones appended, so the rows of df are unchanged when the delta
+    only holds updates.
+    """
+    change = delta['change'].astype(str).to_numpy()
+    delta = delta.drop(columns='change')
+    keys = pd.Index(df[key].astype(str))
+
+    updated = np.flatnonzero(change == "updated")
+    positions = keys.get_indexer(delta[key].iloc[updated].astype(str))
+    found = positions >= 0
+    result = df.copy()
+    if found.any():
+        for name in delta.columns:
+            if name == key:
+                continue
+            column = result[name]
+            if isinstance(column.dtype, pd.CategoricalDtype):
+                # Snapshot encodes the categories again
+                column = column.astype(object)
+            values = column.to_numpy(copy=True)
+            values[positions[found]] = delta[name].to_numpy()[updated[found]]
+            result[name] = values
+
+    removed = keys.isin(delta[key][change == "removed"].astype(str))
+    # updates of rows missing from df are added
+    added = change == "added"
+    added[updated[~found]] = True
+    if removed.any() or added.any():
+        result = pd.concat([result[~removed], delta[added]], ignore_index=True)
+    return result
+
+
+def delta_path(table, run):
+    """Return the path of the delta table of a run, table being the path of
+    the table without TABLE_EXT.
+    """
+    return table + "_" + run + DELTA_EXT
+
+
+def delta_runs(directory, prefix, names):
+    """Return the runs with a delta for every table prefix + "_" + name, oldest first."""
+    runs = {}
+    for file in os.listdir(directory):
+        stem, ext = os.path.splitext(file)
+        if ext == DELTA_EXT and stem.startswith(prefix + "_"):
+            name, _, run = stem[len(prefix) + 1:].rpartition("_")
+            runs.setdefault(run, set()).add(name)
+    return sorted(run for run, run_names in runs.items() if set(names) <= run_names)
+
+
+def read_column(path, name, mmap=True):
+    """Return the raw array of a column, memory-mapped by default."""
+    return np.load(os.path.join(path, name + ".npy"),
+                   mmap_mode="r" if mmap else None,
+                   allow_pickle=False)
+
+
+def read_table(path, mmap=True):
+    """Read a table written by write_table into a DataFrame.
+
+    Numeric columns are memory-mapped when mmap is True, category columns
+    are rebuilt as pandas categoricals.
+    """
+    columns = {}
+    for column in _read_schema(path):
+        name = column['name']
+        values = read_column(path, name, mmap)
+        if column['kind'] == "category":
+            categories = np.load(os.path.join(path, name + ".categories.npy"),
+                                 allow_pickle=False)
+            values = pd.Categorical.from_codes(np.asarray(values), categories)
+        columns[name] = values
+
+    return pd.DataFrame(columns, copy=False)
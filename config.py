@@ -1,9 +1,37 @@
 GOOGLE_API_KEY = 
 DIST_TO_CHECK = 30
+SIMPLIFY_TOLERANCE = DIST_TO_CHECK * 1000 / 300
 MAX_SPEED = 60 / 3.6
+SNAPSHOT_POLL_INTERVAL = 30
+DIRECTIONS_CACHE_SIZE = 10000
+DIRECTIONS_CACHE_TTL = 24 * 3600
+DIRECTIONS_CACHE_DB = None
+UNSHORTEN_CACHE_SIZE = 100000
+UNSHORTEN_CACHE_TTL = 30 * 24 * 3600
+RESULT_CACHE_SIZE = 1000
+RESULT_CACHE_TTL = 24 * 3600
+ROUTING_BACKEND = "google"
+DETOUR_ENGINE = "routes"
+DETOUR_WAVE_SIZE = 5
+DETOUR_WORKERS = 20
+BATCH_WORKERS = 20
+SCORING_WORKERS = 8
+SCORING_PROCESSES = None
+PARALLEL_SCORING_CELLS = 2000000
+SUPERSEDED_RADIUS = 10
+INCREMENTAL_REFRESH = True
+INCREMENTAL_MAX_DELTA = 0.25
+HTTP_TIMEOUT = (3.05, 30)
+HTTP_DOWNLOAD_TIMEOUT = (3.05, 600)
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5
+HTTP_BACKOFF_JITTER = 0.5
+HTTP_MAX_HOSTS = 10
+HTTP_MAX_PER_HOST = 20
 INSTANT_DATA_URL = "https://donnees.roulez-eco.fr/opendata/instantane"
 DAY_DATA_URL = "https://donnees.roulez-eco.fr/opendata/jour"
 SHORTENED_GOOGLE_URL = "https://goo.gl/"
+DIRECTIONS_API_URL = "https://maps.googleapis.com/maps/api/directions/json"
 STATIONS_BY_BRAND_URL = "https://public.opendatasoft.com/explore/dataset/prix_des_carburants_stations/download/?format=csv&timezone=Europe/Berlin&use_labels_for_header=true"
 BAN_API_URL = "https://api-adresse.data.gouv.fr/search/csv/"
 DATA_FOLDER = "C:/Users/Jerome/Dropbox/Python/Station essence/station_webapp/files"
@@ -16,5 +44,8 @@ SUPERSEDED_CSV = DATA_FOLDER + "/" + "superseded.csv"
 BRAND_CSV = DATA_FOLDER + "/" + "stations_by_brand.csv"
 OSM_XML = DATA_FOLDER + "/" + "osm_stations.xml"
 OSM_CSV = DATA_FOLDER + "/" + "osm.csv"
+ROADS_OSM_XML = DATA_FOLDER + "/" + "osm_roads.xml"
+ROAD_GRAPH = DATA_FOLDER + "/" + "road_graph"
+UNSHORTEN_CACHE_DB = DATA_FOLDER + "/" + "unshorten_cache.sqlite"
 DAY_DICT = {1: 'Lun', 2:'Mar', 3: 'Mer', 4: 'Jeu', 5: 'Ven', 6: 'Sam', 7: 'Dim'}
 GAS_DICT = {1: 'Gazole', 2: 'SP95', 3: 'E85', 4: 'GPLc', 5: 'E10', 6: 'SP98'}
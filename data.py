@@ -1,32 +1,537 @@
 from . import config
 import googlemaps
-import polyline
 from .geo import *
+from .cache import LRUCache, SqliteCache
+from .columnar import read_table, read_column, apply_delta, delta_path, delta_runs, TABLE_EXT
+from . import metrics, net
 import numpy as np
 import pandas as pd
+import asyncio
 import datetime
+import functools
+import json
+import logging
 import os
+import threading
+import time
 
-def get_last_update(directory):
-    
-    files_dir = os.listdir(directory)
+logger = logging.getLogger(__name__)
 
-    # Get the most recent df saved in csv files
-    # df file names start with the date in format YYYYMMDDhhmm
-    files_date = []
-    for file in files_dir:
-        try:
-            files_date.append(int(file[:12]))
-        except ValueError:
-            continue
-        
-    return str(max(files_date)) 
+def get_complete_updates(directory, gas_names=config.GAS_DICT.values()):
+    """Return the dates of the sets of files with a table for every gas, most recent first.
+
+    A table is either a binary columnar table or a csv file.
+    """
+    files_by_date = {}
+    for file in os.listdir(directory):
+        name, ext = os.path.splitext(file)
+        date, _, gas_name = name.partition("_")
+        if len(date) == 12 and date.isdigit() and ext in (".csv", TABLE_EXT):
+            files_by_date.setdefault(date, set()).add(gas_name)
+
+    return sorted([date
+                   for date, gas_files in files_by_date.items()
+                   if set(gas_names) <= gas_files],
+                  reverse=True)
+
+
+_table_coords = {}
+
+def table_coords(table_path):
+    """Return the memory-mapped coordinates of a table, kept open by process."""
+    if table_path not in _table_coords:
+        # tables are never modified, only the latest ones are kept open
+        if len(_table_coords) >= 2 * len(config.GAS_DICT):
+            _table_coords.clear()
+        _table_coords[table_path] = (read_column(table_path, 'latitude'),
+                                     read_column(table_path, 'longitude'))
+    return _table_coords[table_path]
+
+def chunk_detours(coords, indices, route_lat, route_lng):
+    """Return the distance in m of the stations indices to a section of a route.
+
+    Run in the scoring processes, see Snapshot.parallel_corridor. coords
+    is the path of the table of the stations, or their coordinates.
+    """
+    if isinstance(coords, str):
+        lat, lng = table_coords(coords)
+        coords = lat[indices], lng[indices]
+    _, min_dist = route_detours(route_lat, route_lng, *coords)
+    return min_dist
+
+
+class Snapshot:
+    """Price table of one gas, loaded in memory with its StationGrid.
+
+    The grid of previous, an older Snapshot, is reused if the stations
+    have the same coordinates. table_path is the binary table df was read
+    from, kept if the rows of df are the rows of the table.
+    """
+
+    categorical_cols = ['Marque', 'services', 'business_hours']
+
+    def __init__(self, df, last_update, previous=None, table_path=None):
+        for col in ['latitude', 'longitude']:
+            if not pd.api.types.is_float_dtype(df[col]):
+                df[col] = pd.to_numeric(df[col], errors='coerce')
+
+        if df[['latitude', 'longitude']].isna().any(axis=None):
+            df = df.dropna(subset=['latitude', 'longitude']).reset_index(drop=True)
+            table_path = None
+
+        for col in self.categorical_cols:
+            if col in df.columns and df[col].dtype != 'category':
+                df[col] = df[col].astype('category')
+
+        self.df = df
+        self.last_update = last_update
+        self.table_path = table_path
+        lat = df['latitude'].to_numpy(dtype=float)
+        lng = df['longitude'].to_numpy(dtype=float)
+        if (previous is not None
+                and np.array_equal(previous.grid.lat, lat)
+                and np.array_equal(previous.grid.lng, lng)):
+            self.grid = previous.grid
+        else:
+            self.grid = StationGrid(lat, lng)
+        self.gas_price = df['gas_price'].to_numpy(dtype=float)
+
+    def cheapest_around(self, lat, lng, dist, liters_to_fill_up, gas_consumption,
+                        trade_off_fn, n=10, chunk_size=64):
+        """Return the n stations within dist m of a point with the lowest
+        estimated trade off cost, as in results.score_stations.
+
+        Return indices, min_dist where min_dist is the distance in m from
+        each station to the point. Stations are scored by increasing price,
+        and the search stops when the fill up cost alone of the next
+        station exceeds the n-th best total cost.
+        """
+        indices = self.grid.candidates([lat], [lng], dist)
+        indices = indices[np.argsort(self.gas_price[indices], kind='stable')]
+        price = self.gas_price[indices]
+
+        best = np.array([], dtype=np.int64)
+        best_dist = np.array([])
+        best_cost = np.array([])
+        for start in range(0, len(indices), chunk_size):
+            if len(best_cost) == n and price[start] * liters_to_fill_up >= best_cost[-1]:
+                break
+
+            chunk = slice(start, start + chunk_size)
+            chunk_dist = exact_distance_arr(self.grid.lat[indices[chunk]],
+                                            self.grid.lng[indices[chunk]],
+                                            lat, lng)
+            near = chunk_dist <= dist
+            detour_dist = 2 * chunk_dist[near]
+            chunk_cost = (price[chunk][near] * (liters_to_fill_up
+                                                + gas_consumption * detour_dist)
+                          + detour_dist / config.MAX_SPEED * trade_off_fn)
+
+            best = np.concatenate((best, indices[chunk][near]))
+            best_dist = np.concatenate((best_dist, chunk_dist[near]))
+            best_cost = np.concatenate((best_cost, chunk_cost))
+            order = np.argsort(best_cost, kind='stable')[:n]
+            best, best_dist, best_cost = best[order], best_dist[order], best_cost[order]
+
+        return best, best_dist
+
+    def parallel_corridor(self, route_lat, route_lng, dist, executor, nb_chunks):
+        """Return the candidate stations near a route and their distance to it.
+
+        The route is split in nb_chunks sections sharing their end points,
+        the candidates of each section are matched to it by chunk_detours
+        on executor, a process pool. The workers read the coordinates from
+        the memory-mapped table of the snapshot if there is one. A station
+        near several sections keeps its smallest distance, which is never
+        larger than the one of route_detours on the whole route.
+        """
+        route_lat = np.asarray(route_lat, dtype=float)
+        route_lng = np.asarray(route_lng, dtype=float)
+        bounds = np.unique(np.linspace(0, len(route_lat) - 1, nb_chunks + 1).astype(int))
+
+        chunks = []
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            chunk_lat = route_lat[first:last + 1]
+            chunk_lng = route_lng[first:last + 1]
+            indices = self.grid.candidates(chunk_lat, chunk_lng, dist)
+            if self.table_path is not None:
+                coords = self.table_path
+            else:
+                coords = self.grid.lat[indices], self.grid.lng[indices]
+            chunks.append((indices, executor.submit(chunk_detours, coords, indices,
+                                                    chunk_lat, chunk_lng)))
+
+        if not chunks:
+            return np.array([], dtype=np.int64), np.array([])
+        indices = np.concatenate([chunk_indices for chunk_indices, _ in chunks])
+        min_dist = np.concatenate([future.result() for _, future in chunks])
+
+        order = np.lexsort((min_dist, indices))
+        indices, first = np.unique(indices[order], return_index=True)
+        return indices, min_dist[order][first]
+
+    def with_delta(self, delta, last_update):
+        """Return the snapshot with the changes of a delta table applied.
+
+        When the delta only updates rows, the stations keep their rows and
+        coordinates, so the grid and the table_path are kept.
+        """
+        snapshot = Snapshot(apply_delta(self.df, delta), last_update, previous=self)
+        if snapshot.grid is self.grid:
+            snapshot.table_path = self.table_path
+        return snapshot
+
+    @classmethod
+    def from_csv(cls, csv_name, last_update, previous=None):
+        return cls(pd.read_csv(csv_name, encoding="utf-8", dtype={"id": str}),
+                   last_update, previous)
+
+    @classmethod
+    def from_table(cls, table_path, last_update, previous=None):
+        return cls(read_table(table_path), last_update, previous, table_path)
+
+    @classmethod
+    def load(cls, directory, last_update, gas_name, previous=None):
+        """Load the binary table of a gas, or its csv file if there is none."""
+        path = directory + "/" + last_update + "_" + gas_name
+        if os.path.isdir(path + TABLE_EXT):
+            return cls.from_table(path + TABLE_EXT, last_update, previous)
+        return cls.from_csv(path + ".csv", last_update, previous)
+
+
+class SnapshotStore:
+    """Process-wide store of the most recent price snapshot of every gas.
+
+    The tables are loaded once, and a watcher thread polls the data folder
+    for new complete sets of files written by refresh_csv.refresh_gas_df,
+    and for the deltas of the following runs. The deltas are applied to
+    the current snapshots, which keep their grids when no station was
+    added or removed. A new set is fully loaded before being swapped in,
+    so readers always get snapshots from the same set and run.
+    """
+
+    def __init__(self, directory, gas_names=config.GAS_DICT.values(),
+                 poll_interval=config.SNAPSHOT_POLL_INTERVAL):
+        self.directory = directory
+        self.gas_names = list(gas_names)
+        self.poll_interval = poll_interval
+        self._state = None
+        self._base_update = None
+        self._places = None
+        self._lock = threading.Lock()
+        self._watcher = None
+
+    @property
+    def last_update(self):
+        state = self._state
+        return state[0] if state is not None else None
+
+    def get(self, gas_name):
+        state = self._state
+        if state is None:
+            self.refresh()
+            self.start_watching()
+            state = self._state
+        return state[1][gas_name]
+
+    def refresh(self):
+        """Load the most recent complete set of tables and its deltas if they are new.
+
+        Return True if new snapshots were swapped in.
+        """
+        with self._lock:
+            updates = get_complete_updates(self.directory, self.gas_names)
+            if not updates:
+                raise FileNotFoundError("No complete set of gas tables in "
+                                        + self.directory)
+
+            base_update = updates[0]
+            runs = delta_runs(self.directory, base_update, self.gas_names)
+            last_update = runs[-1] if runs else base_update
+            if self._state is not None and self._state[0] == last_update:
+                return False
+
+            previous = self._state[1] if self._state is not None else {}
+            with metrics.SNAPSHOT_LOAD_SECONDS.time():
+                if (self._base_update == base_update
+                        and (self._state[0] == base_update or self._state[0] in runs)):
+                    # only the deltas of the new runs are applied
+                    snapshots = previous
+                    runs = [run for run in runs if run > self._state[0]]
+                else:
+                    # the grids of the stations which did not move are kept
+                    snapshots = {gas_name: Snapshot.load(self.directory,
+                                                         base_update,
+                                                         gas_name,
+                                                         previous.get(gas_name))
+                                 for gas_name in self.gas_names}
+                for run in runs:
+                    snapshots = {gas_name: snapshot.with_delta(
+                                     read_table(delta_path(self.directory + "/" + base_update
+                                                           + "_" + gas_name, run),
+                                                mmap=False),
+                                     run)
+                                 for gas_name, snapshot in snapshots.items()}
+
+            self.swap(last_update, snapshots, base_update)
+            return True
+
+    def swap(self, last_update, snapshots, base_update=None):
+        """Replace the current set of snapshots, a dict of Snapshot by gas name.
+
+        base_update is the date of the set of tables the snapshots were
+        loaded from, last_update by default.
+        """
+        self._base_update = base_update or last_update
+        self._state = (last_update, snapshots)
+
+    def find_place(self, waypoint):
+        """Return the (lat, lng) of a station from its "Nom, address" waypoint,
+        as built by results.refine_stations, or None if it is unknown.
+        """
+        state = self._state
+        if state is None:
+            return None
+        places = self._places
+        if places is None or places[0] is not state:
+            places = (state, {})
+            for snapshot in state[1].values():
+                df = snapshot.df
+                waypoints = df['Nom'].astype(str) + ", " + df['address'].astype(str)
+                places[1].update(zip(waypoints, zip(snapshot.grid.lat.tolist(),
+                                                    snapshot.grid.lng.tolist())))
+            self._places = places
+        return places[1].get(waypoint)
+
+    def start_watching(self):
+        with self._lock:
+            if self._watcher is None and self.poll_interval:
+                self._watcher = threading.Thread(target=self._watch, daemon=True)
+                self._watcher.start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.refresh()
+            except Exception:
+                # files removed or still being written for instance, the
+                # current snapshots are kept and the set is retried on next poll
+                metrics.SNAPSHOT_RELOAD_ERRORS.inc()
+                logger.exception("Could not load the price tables of %s, keeping "
+                                 "the snapshots of %s", self.directory, self.last_update)
+
+
+def directions_key(origin, waypoints, destination, alternatives):
+    """Return a cache key for a Google Maps directions request."""
+    if waypoints is None:
+        waypoints = []
+    elif isinstance(waypoints, str):
+        waypoints = [waypoints]
+    return json.dumps([origin, list(waypoints), destination, bool(alternatives)],
+                      ensure_ascii=False)
+
+
+def matrix_key(origin, destination):
+    """Return a cache key for an element of a Google Maps distance matrix."""
+    return json.dumps(["matrix", origin, destination], ensure_ascii=False)
+
+
+class AsyncDirectionsClient:
+    """Google Maps directions requests sent without blocking the event loop.
+
+    Same responses and errors as googlemaps.Client.directions.
+    """
+
+    def __init__(self, key):
+        self.key = key
+
+    async def directions(self, origin, destination, waypoints=None, alternatives=False):
+        params = {"origin": origin, "destination": destination, "key": self.key}
+        if waypoints:
+            params["waypoints"] = waypoints if isinstance(waypoints, str) else "|".join(waypoints)
+        if alternatives:
+            params["alternatives"] = "true"
+
+        response = await net.async_request("GET", config.DIRECTIONS_API_URL, params=params)
+        if response.status_code != 200:
+            raise googlemaps.exceptions.HTTPError(response.status_code)
+        body = response.json()
+        if body["status"] not in ("OK", "ZERO_RESULTS"):
+            raise googlemaps.exceptions.ApiError(body["status"], body.get("error_message"))
+        return body.get("routes", [])
+
+
+class CachedDirectionsClient:
+    """Wrap a googlemaps.Client and cache its directions responses.
+
+    Any object with a directions method can be wrapped, which allows the
+    use of a stub client offline. cache is a cache.LRUCache or
+    cache.SqliteCache. async_client, an AsyncDirectionsClient, is used by
+    directions_async, which runs the directions of client in a thread
+    without it.
+    """
+
+    def __init__(self, client, cache, async_client=None):
+        self.client = client
+        self.cache = cache
+        self.async_client = async_client
+
+    def directions(self, origin, destination, waypoints=None, alternatives=False):
+        key = directions_key(origin, waypoints, destination, alternatives)
+        api_result = self.cache.get(key)
+        if api_result is None:
+            metrics.DIRECTIONS_CACHE.labels(result="miss").inc()
+            with metrics.DIRECTIONS_API_SECONDS.time():
+                api_result = self.client.directions(origin=origin,
+                                                    waypoints=waypoints,
+                                                    destination=destination,
+                                                    alternatives=alternatives)
+            self.cache.set(key, api_result)
+        else:
+            metrics.DIRECTIONS_CACHE.labels(result="hit").inc()
+        return api_result
+
+    async def directions_async(self, origin, destination, waypoints=None, alternatives=False):
+        """Same as directions, without blocking the event loop."""
+        key = directions_key(origin, waypoints, destination, alternatives)
+        api_result = self.cache.get(key)
+        if api_result is None:
+            metrics.DIRECTIONS_CACHE.labels(result="miss").inc()
+            with metrics.DIRECTIONS_API_SECONDS.time():
+                if self.async_client is not None:
+                    api_result = await self.async_client.directions(origin=origin,
+                                                                    waypoints=waypoints,
+                                                                    destination=destination,
+                                                                    alternatives=alternatives)
+                else:
+                    api_result = await asyncio.get_running_loop().run_in_executor(
+                        None, functools.partial(self.client.directions,
+                                                origin=origin,
+                                                waypoints=waypoints,
+                                                destination=destination,
+                                                alternatives=alternatives))
+            self.cache.set(key, api_result)
+        else:
+            metrics.DIRECTIONS_CACHE.labels(result="hit").inc()
+        return api_result
+
+    # limits of a distance matrix request
+    matrix_max_points = 25
+    matrix_max_elements = 100
+
+    def distance_matrix(self, origins, destinations):
+        """Return the matrix of (distance, duration) from origins to destinations.
+
+        The elements are cached one by one, the missing ones are requested
+        in as few distance matrix calls as the API limits allow. Elements
+        without a route are None.
+        """
+        elements = {}
+        missing_origins = []
+        missing_destinations = []
+        for origin in origins:
+            for destination in destinations:
+                element = self.cache.get(matrix_key(origin, destination))
+                if element is None:
+                    if origin not in missing_origins:
+                        missing_origins.append(origin)
+                    if destination not in missing_destinations:
+                        missing_destinations.append(destination)
+                else:
+                    elements[origin, destination] = element
+
+        nb_missing = len(origins) * len(destinations) - len(elements)
+        metrics.DIRECTIONS_CACHE.labels(result="hit").inc(len(elements))
+        metrics.DIRECTIONS_CACHE.labels(result="miss").inc(nb_missing)
+
+        for first in range(0, len(missing_origins), self.matrix_max_points):
+            origins_chunk = missing_origins[first:first + self.matrix_max_points]
+            destinations_step = min(self.matrix_max_points,
+                                    self.matrix_max_elements // len(origins_chunk))
+            for second in range(0, len(missing_destinations), destinations_step):
+                destinations_chunk = missing_destinations[second:second + destinations_step]
+                with metrics.DIRECTIONS_API_SECONDS.time():
+                    api_result = self.client.distance_matrix(origins=origins_chunk,
+                                                             destinations=destinations_chunk)
+                for origin, row in zip(origins_chunk, api_result["rows"]):
+                    for destination, element in zip(destinations_chunk, row["elements"]):
+                        self.cache.set(matrix_key(origin, destination), element)
+                        elements[origin, destination] = element
+
+        matrix = []
+        for origin in origins:
+            row = []
+            for destination in destinations:
+                element = elements[origin, destination]
+                if element.get("status") == "OK":
+                    row.append((element["distance"]["value"], element["duration"]["value"]))
+                else:
+                    row.append(None)
+            matrix.append(row)
+        return matrix
+
+
+_directions_client = None
+
+def get_directions_client(places=None):
+    """Return the process-wide cached directions client.
+
+    The routes are computed by Google Maps, or on the local road graph
+    if config.ROUTING_BACKEND is "local". places is given to the local
+    client to locate the points which are not coordinates, see
+    routing.LocalDirectionsClient.
+    """
+    global _directions_client
+    if _directions_client is None:
+        if config.DIRECTIONS_CACHE_DB:
+            directions_cache = SqliteCache(config.DIRECTIONS_CACHE_DB,
+                                           maxsize=config.DIRECTIONS_CACHE_SIZE,
+                                           ttl=config.DIRECTIONS_CACHE_TTL,
+                                           table="directions")
+        else:
+            directions_cache = LRUCache(maxsize=config.DIRECTIONS_CACHE_SIZE,
+                                        ttl=config.DIRECTIONS_CACHE_TTL)
+        if config.ROUTING_BACKEND == "local":
+            from .routing import RoadGraph, LocalDirectionsClient
+            client = LocalDirectionsClient(RoadGraph.load(config.ROAD_GRAPH),
+                                           places=places)
+            async_client = None
+        else:
+            client = googlemaps.Client(key=config.GOOGLE_API_KEY,
+                                       connect_timeout=config.HTTP_TIMEOUT[0],
+                                       read_timeout=config.HTTP_TIMEOUT[1],
+                                       requests_session=net.session())
+            async_client = AsyncDirectionsClient(config.GOOGLE_API_KEY)
+        _directions_client = CachedDirectionsClient(client, directions_cache, async_client)
+    return _directions_client
+
+
+def decode_polyline(points, precision=5):
+    """Decode an encoded polyline into arrays of latitudes and longitudes.
+
+    Same result as polyline.decode, computed on the whole string at once.
+    """
+    chars = np.frombuffer(points.encode("ascii"), dtype=np.uint8).astype(np.int64) - 63
+    if len(chars) == 0:
+        return np.empty(0), np.empty(0)
+
+    # each value is a group of 5 bit chunks, the last one has no 0x20 flag
+    is_last = (chars & 0x20) == 0
+    group = np.concatenate(([0], np.cumsum(is_last)[:-1]))
+    group_start = np.flatnonzero(np.concatenate(([True], is_last[:-1])))
+    shift = 5 * (np.arange(len(chars)) - group_start[group])
+    values = np.bincount(group, weights=(chars & 0x1f) << shift).astype(np.int64)
+    deltas = np.where(values & 1, ~(values >> 1), values >> 1)
+
+    coord = np.cumsum(deltas.reshape(-1, 2), axis=0) / 10 ** precision
+    return coord[:, 0], coord[:, 1]
 
 
 class MapsRoute:
 
     def __init__(self, origin, waypoints, destination, alternative_route,
-                 km_start=0, km_end=10000):
+                 km_start=0, km_end=10000, client=None):
         self.origin = origin
         self.waypoints = waypoints
         self.destination = destination
@@ -39,8 +544,8 @@ class MapsRoute:
             self.duration = 0
             self.distance = 0
         else:
-            gmaps = googlemaps.Client(key=config.GOOGLE_API_KEY)
-                
+            gmaps = client if client is not None else get_directions_client()
+
             api_result = gmaps.directions(origin=origin,
                                           waypoints=waypoints,
                                           destination=destination,
@@ -60,100 +565,36 @@ class MapsRoute:
             self.lat = [float(self.origin.split(",")[0])]
             self.lng = [float(self.origin.split(",")[1])]
         else:
-            lat = []
-            lng = []
-            distance_to_next_pt = []
-
-            first_leg = True
+            first_leg = self.parsed['legs'][0]
+            lat = [[first_leg['start_location']['lat']]]
+            lng = [[first_leg['start_location']['lng']]]
 
+            # the first point of a step is the end of the previous one
             for leg in self.parsed['legs']:
-                if first_leg:
-                    lat.append(leg['start_location']['lat'])
-                    lng.append(leg['start_location']['lng'])
-                    first_leg = False
                 for step in leg['steps']:
-                    first_tuple = True
-                    for tup in polyline.decode(step['polyline']['points']):
-                        if first_tuple:
-                            first_tuple = False
-                        else:
-                            lat.append(tup[0])
-                            lng.append(tup[1])
-                            distance_to_next_pt.append(exact_distance(lat[-2],
-                                                                      lng[-2],
-                                                                      lat[-1],
-                                                                      lng[-1]))
-
-                    lat.append(step['end_location']['lat'])
-                    lng.append(step['end_location']['lng'])
-                    distance_to_next_pt.append(exact_distance(lat[-2], 
-                                                              lng[-2],
-                                                              lat[-1],
-                                                              lng[-1]))
-                    
-            distance_to_next_pt.insert(0, 0)
-
-            cumul_dist = np.cumsum(distance_to_next_pt)
-
-            self.lat = [lat_pt 
-                        for i, lat_pt 
-                        in enumerate(lat)
-                        if (cumul_dist[i] >= self.km_start * 1000 
-                        and cumul_dist[i] <= self.km_end * 1000)]
-
-            self.lng = [lng_pt 
-                        for i, lng_pt 
-                        in enumerate(lng)
-                        if (cumul_dist[i] >= self.km_start * 1000 
-                        and cumul_dist[i] <= self.km_end * 1000)]
-
-    def get_full_smoothed_route(self):
-        if len(self.lat) > 1 and len(self.lat) > 1:
-            smoothed_polyline = self.parsed['overview_polyline']['points']
-            self.smoothed_points_lat, self.smoothed_points_lng = \
-                list(zip(*polyline.decode(smoothed_polyline)))
-        else:
-            self.smoothed_points_lat = self.lat
-            self.smoothed_points_lng = self.lng
-
-    def transform_coord_to_smoothed(self):
-        if len(self.lat) > 1 and len(self.lat) > 1:
-            start = np.argmin([point_to_line_segment(self.lat[0],
-                                                     self.lng[0],
-                                                     self.smoothed_points_lat[i],
-                                                     self.smoothed_points_lng[i],
-                                                     self.smoothed_points_lat[i + 1],
-                                                     self.smoothed_points_lng[i + 1])
-                               for i in range(len(self.smoothed_points_lat) - 1)])
-
-            end = np.argmin([point_to_line_segment(self.lat[-1],
-                                                   self.lng[-1],
-                                                   self.smoothed_points_lat[i],
-                                                   self.smoothed_points_lng[i],
-                                                   self.smoothed_points_lat[i + 1],
-                                                   self.smoothed_points_lng[i + 1])
-                              for i in range(len(self.smoothed_points_lat) - 1)])
-
-            self.lat = ([self.lat[0]]
-                        + list(self.smoothed_points_lat[start + 1 : end + 1])
-                        + [self.lat[-1]])
-
-            self.lng = ([self.lng[0]] 
-                        + list(self.smoothed_points_lng[start + 1 : end + 1])
-                        + [self.lng[-1]])
-
-    def get_bounds(self):
-        self.NE_lat = max(self.lat)
-        self.NE_lng = max(self.lng)
-        self.SW_lat = min(self.lat)
-        self.SW_lng = min(self.lng)
-
-    def extend_bounds(self, dist_to_extend=float(config.DIST_TO_CHECK)):
-        """Extend a bounding box of a gps route by a defined distance in km."""
-        #Latitude: 1 deg = 110.574 km
-        #Longitude: 1 deg = 111.320 * cos(latitude in radians) km
-        
-        self.NE_lat = self.NE_lat + dist_to_extend / 110.574
-        self.NE_lng = self.NE_lng + dist_to_extend / (111.320 * cos(radians(self.NE_lat)))
-        self.SW_lat = self.SW_lat - dist_to_extend / 110.574
-        self.SW_lng = self.SW_lng - dist_to_extend / (111.320 * cos(radians(self.SW_lat)))
\ No newline at end of file
+                    step_lat, step_lng = decode_polyline(step['polyline']['points'])
+                    lat += [step_lat[1:], [step['end_location']['lat']]]
+                    lng += [step_lng[1:], [step['end_location']['lng']]]
+
+            lat = np.concatenate(lat)
+            lng = np.concatenate(lng)
+
+            cumul_dist = np.concatenate(([0], np.cumsum(
+                exact_distance_arr(lat[:-1], lng[:-1], lat[1:], lng[1:]))))
+
+            first = np.searchsorted(cumul_dist, self.km_start * 1000, side='left')
+            last = np.searchsorted(cumul_dist, self.km_end * 1000, side='right')
+
+            self.lat = lat[first:last]
+            self.lng = lng[first:last]
+
+    def simplify(self, tolerance=config.SIMPLIFY_TOLERANCE):
+        """Simplify the section coordinates with the Douglas-Peucker algorithm.
+
+        Every removed point is at most tolerance m away from the simplified
+        route, so distances from stations to the route are exact within
+        tolerance m.
+        """
+        keep = simplify_route(self.lat, self.lng, tolerance)
+        self.lat = np.asarray(self.lat, dtype=float)[keep]
+        self.lng = np.asarray(self.lng, dtype=float)[keep]
@@ -1,5 +1,9 @@
 from math import sin, cos, sqrt, asin, radians
-from . import config
+try:
+    from . import config
+except ImportError:
+    # refresh_csv is run as a script, next to config.py
+    import config
 import numpy as np
 
 def exact_distance(lat1, lng1, lat2, lng2):
@@ -67,20 +71,6 @@ def min_row(row):
     else:
         return np.NaN
     
-def extend_bounds(northeast_lat, northeast_lng, southwest_lat, southwest_lng, dist_to_extend=config.DIST_TO_CHECK):
-    """Extend a bounding box of a gps route by defined distance in km.
-    To create a bounding box for one point, pass northeast_lat, northeast_lng = southwest_lat, southwest_lng.
-    """
-    #Latitude: 1 deg = 110.574 km
-    #Longitude: 1 deg = 111.320 * cos(latitude in radians) km
-    
-    new_northeast_lat = northeast_lat + dist_to_extend / 110.574
-    new_northeast_lng = northeast_lng + dist_to_extend / (111.320 * cos(radians(northeast_lat)))
-    new_southwest_lat = southwest_lat - dist_to_extend / 110.574
-    new_southwest_lng = southwest_lng - dist_to_extend / (111.320 * cos(radians(southwest_lat)))
-    
-    return new_northeast_lat, new_northeast_lng, new_southwest_lat, new_southwest_lng
-
 def equirect_proj(origin_lat, origin_lng, pt_lat, pt_lng):
     """Compute x, y distance in m using the equirectangular projection.
     Return pt_x, pt_y
@@ -147,4 +137,241 @@ def exact_dist_to_segments(row, route):
         dist_to_next_seg = point_to_line_segment(row['latitude'], row['longitude'], 
                                              route.lat[i], route.lng[i],
                                              route.lat[i + 1], route.lng[i + 1])
-    return min(dist_to_prev_seg, dist_to_next_seg)
\ No newline at end of file
+    return min(dist_to_prev_seg, dist_to_next_seg)
+
+def equirectangular_dist_matrix(lat1_arr, lng1_arr, lat2_arr, lng2_arr):
+    """Vectorized equirectangular_dist between every pair of points.
+
+    Points 1 are used as the origins of the projection.
+    Return an array of shape (len(lat2_arr), len(lat1_arr)) in m.
+    """
+    lat1_arr = np.asarray(lat1_arr, dtype=float)
+    lng1_arr = np.asarray(lng1_arr, dtype=float)
+    lat2_arr = np.asarray(lat2_arr, dtype=float)
+    lng2_arr = np.asarray(lng2_arr, dtype=float)
+
+    x = (lng2_arr[:, None] - lng1_arr[None, :]) * np.cos(np.radians(lat1_arr))[None, :] * 110574
+    y = (lat2_arr[:, None] - lat1_arr[None, :]) * 111320
+    return np.hypot(x, y)
+
+
+def coord_to_x_y_arr(origin_lat, origin_lng, pt_lat, pt_lng):
+    """Vectorized coord_to_x_y."""
+    origin_lat = np.asarray(origin_lat, dtype=float)
+    x = (np.asarray(pt_lng, dtype=float) - origin_lng) * np.cos(np.radians(origin_lat)) * 110574
+    y = (np.asarray(pt_lat, dtype=float) - origin_lat) * 111320
+    return x, y
+
+
+def points_to_line_segments(pt_lat, pt_lng, line_pt_1_lat, line_pt_1_lng, line_pt_2_lat, line_pt_2_lng):
+    """Vectorized point_to_line_segment, all arguments are broadcast together.
+
+    The point is projected on the segment and the projection is clamped to
+    the segment endpoints, so degenerate segments return the distance to the
+    endpoint.
+    """
+    line_x, line_y = coord_to_x_y_arr(line_pt_1_lat, line_pt_1_lng, line_pt_2_lat, line_pt_2_lng)
+    pt_x, pt_y = coord_to_x_y_arr(line_pt_1_lat, line_pt_1_lng, pt_lat, pt_lng)
+
+    sq_length = line_x ** 2 + line_y ** 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.where(sq_length > 0, (pt_x * line_x + pt_y * line_y) / sq_length, 0)
+    t = np.clip(t, 0, 1)
+
+    return np.hypot(pt_x - t * line_x, pt_y - t * line_y)
+
+
+def exact_distance_arr(lat1, lng1, lat2, lng2):
+    """Vectorized exact_distance, all arguments are broadcast together."""
+    p = 0.017453292519943295     #Pi/180
+    lat1 = np.asarray(lat1, dtype=float)
+    lat2 = np.asarray(lat2, dtype=float)
+    a = (0.5 - np.cos((lat2 - lat1) * p) / 2
+         + np.cos(lat1 * p) * np.cos(lat2 * p) * (1 - np.cos((np.asarray(lng2) - lng1) * p)) / 2)
+    return 12735000 * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def simplify_route(lat, lng, tolerance):
+    """Douglas-Peucker simplification of a route.
+
+    Return the indices of the points to keep: every removed point is at
+    most tolerance m away from the simplified route. The first and last
+    points are always kept.
+    """
+    lat = np.asarray(lat, dtype=float)
+    lng = np.asarray(lng, dtype=float)
+    nb_pts = len(lat)
+
+    if nb_pts < 3:
+        return np.arange(nb_pts)
+
+    keep = np.zeros(nb_pts, dtype=bool)
+    keep[0] = keep[-1] = True
+
+    sections = [(0, nb_pts - 1)]
+    while sections:
+        first, last = sections.pop()
+        if last - first < 2:
+            continue
+        dist = points_to_line_segments(lat[first + 1:last], lng[first + 1:last],
+                                       lat[first], lng[first],
+                                       lat[last], lng[last])
+        farthest = int(np.argmax(dist))
+        if dist[farthest] > tolerance:
+            index = first + 1 + farthest
+            keep[index] = True
+            sections.append((first, index))
+            sections.append((index, last))
+
+    return np.flatnonzero(keep)
+
+
+def route_detours(route_lat, route_lng, pts_lat, pts_lng, chunk_size=2048):
+    """Match points (stations) to a route in a single batched computation.
+
+    For each point, find the closest route point and the distance in m to the
+    route segments before and after it.
+    Return closest_pt, min_dist as NumPy arrays of the length of pts_lat.
+    For a route made of a single point, min_dist is the exact distance to it.
+    The matrix is computed by chunks of points to bound memory usage.
+    """
+    route_lat = np.asarray(route_lat, dtype=float)
+    route_lng = np.asarray(route_lng, dtype=float)
+    pts_lat = np.asarray(pts_lat, dtype=float)
+    pts_lng = np.asarray(pts_lng, dtype=float)
+
+    if len(route_lat) != len(route_lng) or len(pts_lat) != len(pts_lng):
+        raise ValueError("Error, latitude and longitude columns have different lengths")
+
+    nb_pts = len(pts_lat)
+    nb_route_pts = len(route_lat)
+
+    if nb_route_pts == 0 or nb_pts == 0:
+        return np.zeros(nb_pts, dtype=int), np.full(nb_pts, np.inf)
+
+    if nb_route_pts == 1:
+        return (np.zeros(nb_pts, dtype=int),
+                exact_distance_arr(pts_lat, pts_lng, route_lat[0], route_lng[0]))
+
+    closest_pt = np.empty(nb_pts, dtype=int)
+    for start in range(0, nb_pts, chunk_size):
+        end = start + chunk_size
+        closest_pt[start:end] = np.argmin(
+            equirectangular_dist_matrix(route_lat, route_lng,
+                                        pts_lat[start:end], pts_lng[start:end]),
+            axis=1)
+
+    prev_pt = np.maximum(closest_pt - 1, 0)
+    next_pt = np.minimum(closest_pt + 1, nb_route_pts - 1)
+
+    dist_to_prev_seg = np.where(
+        closest_pt > 0,
+        points_to_line_segments(pts_lat, pts_lng,
+                                route_lat[prev_pt], route_lng[prev_pt],
+                                route_lat[closest_pt], route_lng[closest_pt]),
+        np.inf)
+    dist_to_next_seg = np.where(
+        closest_pt < nb_route_pts - 1,
+        points_to_line_segments(pts_lat, pts_lng,
+                                route_lat[closest_pt], route_lng[closest_pt],
+                                route_lat[next_pt], route_lng[next_pt]),
+        np.inf)
+
+    return closest_pt, np.minimum(dist_to_prev_seg, dist_to_next_seg)
+
+
+class StationGrid:
+    """Spatial index of station coordinates on a regular lat/lng grid.
+
+    Cells are at least cell_size m wide everywhere in the indexed area, so
+    the stations within a given distance of a point are found in the
+    surrounding cells only. Build it once per price snapshot and query it
+    with candidates() for each route, then keep the candidates within the
+    distance of the route computed by route_detours.
+    """
+
+    def __init__(self, lat, lng, cell_size=config.DIST_TO_CHECK * 1000 / 4):
+        self.lat = np.asarray(lat, dtype=float)
+        self.lng = np.asarray(lng, dtype=float)
+        self.cell_size = cell_size
+
+        if len(self.lat) != len(self.lng):
+            raise ValueError("Error, latitude and longitude columns have different lengths")
+
+        if len(self.lat):
+            max_abs_lat = np.max(np.abs(self.lat))
+            self.lat_0 = np.min(self.lat)
+            self.lng_0 = np.min(self.lng)
+            self.nb_rows = int((np.max(self.lat) - self.lat_0) // (cell_size / 110574)) + 1
+        else:
+            max_abs_lat = 0
+            self.lat_0 = self.lng_0 = 0
+            self.nb_rows = 1
+
+        self.cell_lat = cell_size / 110574
+        self.cell_lng = cell_size / (111320 * cos(radians(min(max_abs_lat, 89))))
+
+        keys = self._cell_keys(*self._cells(self.lat, self.lng))
+        self.order = np.argsort(keys, kind='stable')
+        self.keys, self.starts, self.counts = np.unique(keys[self.order],
+                                                        return_index=True,
+                                                        return_counts=True)
+
+    def __len__(self):
+        return len(self.lat)
+
+    def _cells(self, lat, lng):
+        rows = np.floor((np.asarray(lat) - self.lat_0) / self.cell_lat).astype(np.int64)
+        cols = np.floor((np.asarray(lng) - self.lng_0) / self.cell_lng).astype(np.int64)
+        return rows, cols
+
+    def _cell_keys(self, rows, cols):
+        return cols * self.nb_rows + rows
+
+    def cells_stations(self, rows, cols):
+        """Return the indices of the stations located in the given cells."""
+        valid = (rows >= 0) & (rows < self.nb_rows)
+        keys = np.unique(self._cell_keys(rows[valid], cols[valid]))
+
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        pos = pos[self.keys[pos] == keys]
+
+        starts = self.starts[pos]
+        counts = self.counts[pos]
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        return np.sort(self.order[offsets + np.arange(counts.sum())])
+
+    def candidates(self, route_lat, route_lng, dist):
+        """Return the indices of the stations in the cells near the route.
+
+        All the stations within dist m of the route polyline are returned,
+        along with some stations a bit farther away.
+        """
+        route_lat = np.asarray(route_lat, dtype=float)
+        route_lng = np.asarray(route_lng, dtype=float)
+
+        if len(route_lat) == 0 or len(self) == 0:
+            return np.array([], dtype=np.int64)
+
+        # sample the route so that every point of the polyline
+        # is within step / 2 m of a sample
+        step = self.cell_size / 2
+        seg_length = exact_distance_arr(route_lat[:-1], route_lng[:-1],
+                                        route_lat[1:], route_lng[1:])
+        nb_samples = np.ceil(seg_length / step).astype(np.int64)
+        seg = np.repeat(np.arange(len(seg_length)), nb_samples)
+        frac = (np.arange(nb_samples.sum()) 
+                - np.repeat(np.cumsum(nb_samples) - nb_samples, nb_samples)) \
+               / np.repeat(np.maximum(nb_samples, 1), nb_samples)
+        sample_lat = np.append(route_lat[seg] + frac * (route_lat[seg + 1] - route_lat[seg]),
+                               route_lat[-1])
+        sample_lng = np.append(route_lng[seg] + frac * (route_lng[seg + 1] - route_lng[seg]),
+                               route_lng[-1])
+
+        ring = int(np.ceil((dist + step / 2) / self.cell_size))
+        offsets = np.arange(-ring, ring + 1)
+        rows, cols = self._cells(sample_lat, sample_lng)
+        rows = (rows[:, None, None] + offsets[None, :, None]).repeat(len(offsets), axis=2)
+        cols = (cols[:, None, None] + offsets[None, None, :]).repeat(len(offsets), axis=1)
+
+        return self.cells_stations(rows.ravel(), cols.ravel())
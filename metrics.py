@@ -0,0 +1,188 @@
+import bisect
+import contextlib
+import threading
+import time
+
+# Prometheus-style counters and histograms, rendered in the text
+# exposition format by render() for the /metrics endpoint.
+
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 50000)
+SIZE_BUCKETS = (1e2, 1e3, 1e4, 1e5, 1e6, 1e7, 1e8)
+
+_registry = []
+_lock = threading.Lock()
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        with _lock:
+            _registry.append(self)
+
+    def labels(self, **labels):
+        key = tuple((name, str(labels[name])) for name in self.labelnames)
+        with _lock:
+            if key not in self._children:
+                self._children[key] = self._new_child()
+            return self._children[key]
+
+    def _default(self):
+        return self.labels()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} {self.kind}"]
+        with _lock:
+            children = list(self._children.items())
+        for labels, child in children:
+            lines += child.render(self.name, labels)
+        return lines
+
+
+class _CounterChild:
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def render(self, name, labels):
+        return [f"{name}{_format_labels(labels)} {_format_value(self.value)}"]
+
+
+class Counter(Metric):
+
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+
+class _HistogramChild:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+
+    @contextlib.contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def render(self, name, labels):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = []
+        cumulated = 0
+        for bound, count in zip(list(self.buckets) + [float("inf")], counts):
+            cumulated += count
+            lines.append(f"{name}_bucket"
+                         f"{_format_labels(labels, [('le', _format_value(bound))])}"
+                         f" {cumulated}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(float(total))}")
+        lines.append(f"{name}_count{_format_labels(labels)} {cumulated}")
+        return lines
+
+
+class Histogram(Metric):
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=TIME_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+
+def render():
+    """Return every metric in the Prometheus text exposition format."""
+    with _lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+STAGE_SECONDS = Histogram("easycarbu_stage_seconds",
+                          "Duration of the stages of get_results.",
+                          labelnames=["stage"])
+DIRECTIONS_API_SECONDS = Histogram("easycarbu_directions_api_seconds",
+                                   "Duration of the Google Maps directions calls.")
+DIRECTIONS_CACHE = Counter("easycarbu_directions_cache_total",
+                           "Directions requests by cache result.",
+                           labelnames=["result"])
+UNSHORTEN_SECONDS = Histogram("easycarbu_unshorten_seconds",
+                              "Duration of the short url expansions.")
+UNSHORTEN_CACHE = Counter("easycarbu_unshorten_cache_total",
+                          "Short url expansions by cache result.",
+                          labelnames=["result"])
+RESULT_CACHE = Counter("easycarbu_result_cache_total",
+                       "Results of get_results by cache result.",
+                       labelnames=["result"])
+SNAPSHOT_LOAD_SECONDS = Histogram("easycarbu_snapshot_load_seconds",
+                                  "Duration of the loading of a set of price tables.")
+SNAPSHOT_RELOAD_ERRORS = Counter("easycarbu_snapshot_reload_errors_total",
+                                 "Failed reloads of the price tables by the watcher.")
+CORRIDOR_CANDIDATES = Histogram("easycarbu_corridor_candidates",
+                                "Number of stations found near the route.",
+                                buckets=COUNT_BUCKETS)
+DISTANCE_MATRIX_CELLS = Histogram("easycarbu_distance_matrix_cells",
+                                  "Number of route points times candidate stations.",
+                                  buckets=SIZE_BUCKETS)
+REFINEMENT_ROUTES = Histogram("easycarbu_refinement_routes",
+                              "Number of detour routes evaluated per request.",
+                              buckets=COUNT_BUCKETS)
+REQUESTS = Counter("easycarbu_requests_total",
+                   "Requests to get_results by outcome.",
+                   labelnames=["outcome"])
+
+
+def stage_timer(stage):
+    """Timer for get_results recording the stage durations."""
+    return STAGE_SECONDS.labels(stage=stage).time()
@@ -0,0 +1,141 @@
+import asyncio
+import contextlib
+import random
+import threading
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    from . import config
+except ImportError:
+    # refresh_csv is run as a script, next to config.py
+    import config
+
+# Shared HTTP layer of the app and the refresh scripts: a single pooled
+# session with keep-alive, default timeouts, bounded retries with a
+# jittered exponential backoff, and a limit of concurrent requests per host.
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_session = None
+_session_lock = threading.Lock()
+_host_semaphores = {}
+_async_client = None
+_async_host_semaphores = {}
+
+
+def session():
+    """Return the process-wide requests.Session."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(total=config.HTTP_RETRIES,
+                          backoff_factor=config.HTTP_BACKOFF,
+                          backoff_jitter=config.HTTP_BACKOFF_JITTER,
+                          status_forcelist=RETRY_STATUSES,
+                          raise_on_status=False)
+            # pool_block also limits the connections per host of the
+            # clients given the session directly, like googlemaps.Client
+            adapter = HTTPAdapter(pool_connections=config.HTTP_MAX_HOSTS,
+                                  pool_maxsize=config.HTTP_MAX_PER_HOST,
+                                  pool_block=True,
+                                  max_retries=retry)
+            _session = requests.Session()
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+def close():
+    """Close the pooled connections, a new session is created on next use."""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+@contextlib.contextmanager
+def host_limit(url):
+    """Block while config.HTTP_MAX_PER_HOST requests to the host of url are running."""
+    host = urlsplit(url).netloc
+    with _session_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(config.HTTP_MAX_PER_HOST)
+        semaphore = _host_semaphores[host]
+    with semaphore:
+        yield
+
+
+def request(method, url, **kwargs):
+    """Send a request through the shared session and return the response.
+
+    The body is read before returning, use stream() for large downloads.
+    timeout defaults to config.HTTP_TIMEOUT.
+    """
+    kwargs.setdefault("timeout", config.HTTP_TIMEOUT)
+    with host_limit(url):
+        return session().request(method, url, **kwargs)
+
+
+@contextlib.contextmanager
+def stream(method, url, **kwargs):
+    """Send a request and yield the response with its body not read yet.
+
+    The connection counts in the host limit until the response is closed.
+    """
+    kwargs.setdefault("timeout", config.HTTP_TIMEOUT)
+    with host_limit(url):
+        response = session().request(method, url, stream=True, **kwargs)
+        try:
+            yield response
+        finally:
+            response.close()
+
+
+def async_client():
+    """Return the process-wide httpx.AsyncClient of the async front-end."""
+    global _async_client
+    if _async_client is None:
+        import httpx
+        limits = httpx.Limits(max_connections=config.HTTP_MAX_HOSTS * config.HTTP_MAX_PER_HOST,
+                              max_keepalive_connections=config.HTTP_MAX_HOSTS
+                              * config.HTTP_MAX_PER_HOST)
+        # the transport retries the failed connections, the statuses
+        # are retried by async_request
+        transport = httpx.AsyncHTTPTransport(retries=config.HTTP_RETRIES, limits=limits)
+        _async_client = httpx.AsyncClient(transport=transport,
+                                          timeout=httpx.Timeout(config.HTTP_TIMEOUT[1],
+                                                                connect=config.HTTP_TIMEOUT[0]))
+    return _async_client
+
+
+async def async_close():
+    """Close the connections of the async client."""
+    global _async_client
+    if _async_client is not None:
+        client, _async_client = _async_client, None
+        await client.aclose()
+
+
+async def async_request(method, url, **kwargs):
+    """Send a request without blocking the event loop and return the response.
+
+    Same limits as request(): config.HTTP_MAX_PER_HOST concurrent requests
+    by host, and the RETRY_STATUSES retried with a jittered exponential
+    backoff.
+    """
+    host = urlsplit(url).netloc
+    if host not in _async_host_semaphores:
+        _async_host_semaphores[host] = asyncio.Semaphore(config.HTTP_MAX_PER_HOST)
+
+    async with _async_host_semaphores[host]:
+        for retry in range(config.HTTP_RETRIES + 1):
+            response = await async_client().request(method, url, **kwargs)
+            if response.status_code not in RETRY_STATUSES or retry == config.HTTP_RETRIES:
+                return response
+            await response.aclose()
+            await asyncio.sleep(config.HTTP_BACKOFF * 2 ** retry
+                                + random.uniform(0, config.HTTP_BACKOFF_JITTER))
@@ -1,32 +1,45 @@
-import requests
 import zipfile
-import io
-import xml.etree.ElementTree as ET
 import datetime
 import pandas as pd
 import numpy as np
 import config
+import columnar
+import net
+from xmlstream import iter_elements
+from routing import RoadGraph, HIGHWAY_SPEEDS
 import os
+import shutil
 import unicodedata
 import csv
+import tempfile
+import contextlib
+from array import array
+
+@contextlib.contextmanager
+def open_zipped_xml(url):
+    """Download a zip file by chunks and yield its first member as a stream.
+
+    The zip file is spooled to a temporary file, and the xml member is
+    decompressed on the fly while it is read.
+    """
+    with net.stream("GET", url, timeout=config.HTTP_DOWNLOAD_TIMEOUT) as response, \
+         tempfile.TemporaryFile() as zip_file:
+        for chunk in response.iter_content(chunk_size=1 << 16):
+            zip_file.write(chunk)
+        zip_file.seek(0)
+
+        with zipfile.ZipFile(zip_file) as zf:
+            with zf.open(zf.namelist()[0]) as xml_file:
+                yield xml_file
 
 def refresh_all_stations():
     gas_dict = config.GAS_DICT
     day_dict = config.DAY_DICT
     data_folder = config.DATA_FOLDER
 
-    with requests.get(config.DAY_DATA_URL) as fetch_url:
-        with zipfile.ZipFile(io.BytesIO(fetch_url.content)) as zf:
-            xml_file = zipfile.ZipFile.namelist(zf)[0]
-            with zf.open(xml_file) as xml_file:
-                parsed_xml = ET.parse(xml_file)
-
-    cols_all_stations = ['id', 'lat', 'lng', 
-                         'adresse', 'cp', 'ville',
-                         'services', 'automate_h24', 'active']
     ids = []
-    lat = []
-    lng = []
+    lat = array('d')
+    lng = array('d')
     adresse = []
     cp = []
     ville = []
@@ -34,53 +47,57 @@ def refresh_all_stations():
     automate_h24 = []
     active = []
 
-    for pdv in parsed_xml.getroot().findall('pdv'):
-        cp.append(pdv.get('cp'))
-        lng.append(pdv.get('longitude'))
-        lat.append(pdv.get('latitude'))
-        ids.append(pdv.get('id'))
-        adresse.append(
-            (", ").join([address.text for address in pdv.findall('adresse')])
-        )
-        ville.append(pdv.find('ville').text)
-
-        if pdv.find('services') is None:
-            services.append(None)
-        else:
-            pdv_services = [service.text for service in pdv.find('services')]
-            services.append(("|").join(pdv_services))
+    with open_zipped_xml(config.DAY_DATA_URL) as xml_file:
+        for pdv in iter_elements(xml_file, ('pdv',)):
+            cp.append(pdv.get('cp'))
+            lng.append(float(pdv.get('longitude') or "nan"))
+            lat.append(float(pdv.get('latitude') or "nan"))
+            ids.append(pdv.get('id'))
+            adresse.append(
+                (", ").join([address.text for address in pdv.findall('adresse')])
+            )
+            ville.append(pdv.find('ville').text)
+
+            if pdv.find('services') is None:
+                pdv_services = []
+                services.append(None)
+            else:
+                pdv_services = [service.text for service in pdv.find('services')]
+                services.append(("|").join(pdv_services))
 
-        if "Automate CB" in pdv_services:
-            automate_h24.append(True)
-        else:
             horaires_node = pdv.find('horaires')
-            if horaires_node is None:
+
+            if "Automate CB" in pdv_services:
+                automate_h24.append(True)
+            elif horaires_node is None:
                 automate_h24.append(False)
             else:
                 automate_h24.append(bool(horaires_node.get('automate-24-24')))
 
-        if pdv.find("prix") is not None:
-            nb_jours = 0
-            if pdv.find("horaires"):
-                for jour in pdv.find("horaires").findall("jour"):
-                    if jour.get("ferme") == "1":
-                        nb_jours += 1
-                if nb_jours == 7:
-                    active.append(False)
+            if pdv.find("prix") is not None:
+                nb_jours = 0
+                if horaires_node is not None and len(horaires_node):
+                    for jour in horaires_node.findall("jour"):
+                        if jour.get("ferme") == "1":
+                            nb_jours += 1
+                    active.append(nb_jours != 7)
                 else:
                     active.append(True)
             else:
-                active.append(True)
-        else:
-            active.append(False)
+                active.append(False)
 
-    all_stations = pd.DataFrame(np.array([ids, lat, lng,
-                                          adresse, cp, ville,
-                                          services, automate_h24, active]).T, 
-                                columns=cols_all_stations)
+    all_stations = pd.DataFrame({'id': ids,
+                                 'lat': np.frombuffer(lat),
+                                 'lng': np.frombuffer(lng),
+                                 'adresse': adresse,
+                                 'cp': cp,
+                                 'ville': ville,
+                                 'services': services,
+                                 'automate_h24': np.array(automate_h24, dtype=bool),
+                                 'active': np.array(active, dtype=bool)})
 
-    all_stations['lat'] = round(pd.to_numeric(all_stations['lat']) / 100000, 6)
-    all_stations['lng'] = round(pd.to_numeric(all_stations['lng']) / 100000, 6)
+    all_stations['lat'] = round(all_stations['lat'] / 100000, 6)
+    all_stations['lng'] = round(all_stations['lng'] / 100000, 6)
 
     all_stations['address'] = all_stations.adresse.apply(lambda x: x.replace(",", "").replace("-", "")) + " " + all_stations.cp + " " + all_stations.ville
     all_stations['lower_address'] = all_stations['address'].str.lower()
@@ -99,7 +116,7 @@ def refresh_geocoded_addresses():
 
     with open(csv_file, 'rb') as f:
         data = {"data": (csv_file, f)}
-        r = requests.post(url, files=data)
+        r = net.request("POST", url, files=data, timeout=config.HTTP_DOWNLOAD_TIMEOUT)
 
     data = [line.split("\r") for line in r.text.replace("\r\n", "\n").split("\n")]
 
@@ -126,26 +143,96 @@ def refresh_BAN():
                   quoting=csv.QUOTE_NONNUMERIC, encoding="utf-8")
 
 
+def _union_pairs(parent, first, second):
+    """Merge the clusters of every (first[k], second[k]) pair of a union-find forest."""
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in zip(first.tolist(), second.tolist()):
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    return np.array([find(i) for i in range(len(parent))])
+
+def _same_key_pairs(keys):
+    """Return the pairs (i, first index with the same key) for non null keys."""
+    codes, _ = pd.factorize(keys)
+    index = np.arange(len(codes))
+    valid = codes >= 0
+    first = pd.Series(index[valid]).groupby(codes[valid]).transform('first').values
+    return index[valid], first
+
+def _close_coord_pairs(lat, lng, radius):
+    """Return the pairs of points closer than radius m, using a spatial hash.
+
+    Points are hashed in square cells of radius m, so close points are in
+    the same cell or in adjacent ones.
+    """
+    y = lat * 111320
+    x = lng * np.cos(np.radians(lat)) * 111320
+    valid = np.isfinite(y) & np.isfinite(x)
+    cells = pd.DataFrame({'index': np.arange(len(lat))[valid],
+                          'row': np.floor(y[valid] / radius).astype(np.int64),
+                          'col': np.floor(x[valid] / radius).astype(np.int64)})
+
+    first = []
+    second = []
+    # half of the neighbourhood, the other half gives the same pairs
+    for d_row, d_col in [(0, 0), (0, 1), (1, -1), (1, 0), (1, 1)]:
+        shifted = cells.assign(row=cells['row'] + d_row, col=cells['col'] + d_col)
+        pairs = cells.merge(shifted, on=['row', 'col'], suffixes=('', '_other'))
+        pairs = pairs[pairs['index'] != pairs['index_other']]
+        i = pairs['index'].values
+        j = pairs['index_other'].values
+        close = np.hypot(x[i] - x[j], y[i] - y[j]) <= radius
+        first.append(i[close])
+        second.append(j[close])
+
+    return np.concatenate(first), np.concatenate(second)
+
+def cluster_stations(all_stations, radius=config.SUPERSEDED_RADIUS):
+    """Return a cluster label for every station.
+
+    Stations sharing their lower_address, or located within radius m of
+    each other, are in the same cluster. With radius = 0, coordinates must
+    be exactly equal.
+    """
+    parent = np.arange(len(all_stations))
+
+    first, second = _same_key_pairs(all_stations['lower_address'].values)
+    parent = _union_pairs(parent, first, second)
+
+    lat = all_stations['lat'].values.astype(float)
+    lng = all_stations['lng'].values.astype(float)
+    if radius > 0:
+        first, second = _close_coord_pairs(lat, lng, radius)
+    else:
+        coords = pd.Series(list(zip(lat, lng))).where(~(np.isnan(lat) | np.isnan(lng)))
+        first, second = _same_key_pairs(coords.values)
+
+    return _union_pairs(parent, first, second)
+
 def refresh_superseded():
 
     all_stations = pd.read_csv(config.STATIONS_CSV, encoding="utf-8")
-    no_duplicate = all_stations.drop_duplicates(['lat', 'lng'], keep=False) \
-                               .drop_duplicates(['lower_address'], keep=False)
-    duplicate = all_stations[~all_stations.index.isin(no_duplicate.index)]
-    
-    data = []
-    for i, row in duplicate.iterrows():
-        dup_row = duplicate[((duplicate['lat'] == row['lat'])
-                           &
-                           (duplicate['lng'] == row['lng']))
-                          | (duplicate['lower_address'] == row['lower_address'])]
-        
-        if not dup_row[dup_row['active']].empty:
-            last_active = max(dup_row[dup_row['active']].index)
-            if last_active != i and row['active'] == False:
-                data.append([row['id'], all_stations.loc[last_active]['id']])
-
-    superseded_df = pd.DataFrame(data, columns=["id", "superseded_by"])
+    all_stations['cluster'] = cluster_stations(all_stations)
+
+    # in each cluster, the inactive stations are superseded by
+    # the last active one
+    last_active = all_stations[all_stations['active']] \
+                      .reset_index() \
+                      .groupby('cluster')['index'].max()
+    superseded_by = all_stations['cluster'].map(last_active)
+    superseded = (~all_stations['active']) & superseded_by.notna()
+
+    superseded_df = pd.DataFrame({
+        "id": all_stations.loc[superseded, 'id'].values,
+        "superseded_by": all_stations.loc[superseded_by[superseded].astype(int), 'id'].values
+    })
     superseded_df.to_csv(config.SUPERSEDED_CSV, index=False, 
                          quoting=csv.QUOTE_NONNUMERIC, encoding="utf-8")
 
@@ -160,9 +247,33 @@ def refresh_osm_xml():
     out%20geom;
     """
 
-    with requests.get(over_pass_query) as response:
+    with net.stream("GET", over_pass_query,
+                    timeout=config.HTTP_DOWNLOAD_TIMEOUT) as response:
         with open(config.OSM_XML, "wb") as f:
-            f.write(response.content)
+            for chunk in response.iter_content(chunk_size=1 << 16):
+                f.write(chunk)
+
+def refresh_road_graph():
+    """Download the routable ways of France and build the graph of the local
+    routing backend from them.
+    """
+    highways = "|".join(HIGHWAY_SPEEDS)
+    over_pass_query = f"""http://overpass-api.de/api/interpreter?data=
+    [out:xml][timeout:3600];
+    area[name=France]->.boundaryarea;(
+        way(area.boundaryarea)[highway~"^({highways})$"];
+    );
+    (._;>;);
+    out;
+    """
+
+    with net.stream("GET", over_pass_query,
+                    timeout=config.HTTP_DOWNLOAD_TIMEOUT) as response:
+        with open(config.ROADS_OSM_XML, "wb") as f:
+            for chunk in response.iter_content(chunk_size=1 << 16):
+                f.write(chunk)
+
+    RoadGraph.from_osm_xml(config.ROADS_OSM_XML).save(config.ROAD_GRAPH)
 
 def refresh_osm_df():
     tag_list = ["ref:FR:prix-carburants",
@@ -170,247 +281,282 @@ def refresh_osm_df():
                 #"address", "addr:housenumber", "addr:street", "addr:postcode", "addr:city", "is_in",
                 "opening_hours"]
 
-    parsed_xml = ET.parse(config.OSM_XML)
-
-    data = []
-    for objects in ["node", "way", "relation"]:
-        for obj in parsed_xml.getroot().findall(objects):
-            data_row = []
-            data_row.append(objects)
-            data_row.append(obj.get("id"))
-            if objects == "node":
-                
-                data_row.append(float(obj.get("lat")))
-                data_row.append(float(obj.get("lon")))
+    tags_to_get = set(tag_list)
+
+    # rows are grouped by object type to keep nodes first, then ways and relations
+    data = {"node": [], "way": [], "relation": []}
+
+    with open(config.OSM_XML, "rb") as xml_file:
+        for obj in iter_elements(xml_file, tuple(data)):
+            if obj.tag == "node":
+                obj_lat = float(obj.get("lat"))
+                obj_lng = float(obj.get("lon"))
             else:
                 bounds = obj.find("bounds")
-                avg_lat = 0.5 * (float(bounds.get("minlat")) + float(bounds.get("maxlat")))
-                avg_lng = 0.5 * (float(bounds.get("minlon")) + float(bounds.get("maxlon")))
-
-                data_row.append(round(avg_lat, 6))
-                data_row.append(round(avg_lng, 6))
-                
-            for tag_to_get in tag_list:
-                value = None
-                for tag in obj.findall("tag"):
-                    if tag.get("k") == tag_to_get:
-                        value = tag.get("v")
-                data_row.append(value)
-
-            data.append(data_row)
-            
-    df_osm = pd.DataFrame(data, columns=["osm_obj", "osm_id", "osm_lat", "osm_lng"] + ["osm_" + tag for tag in tag_list])
+                obj_lat = round(0.5 * (float(bounds.get("minlat"))
+                                       + float(bounds.get("maxlat"))), 6)
+                obj_lng = round(0.5 * (float(bounds.get("minlon"))
+                                       + float(bounds.get("maxlon"))), 6)
+
+            # single pass on the tags, the last value of a key is kept
+            tags = {tag.get("k"): tag.get("v")
+                    for tag in obj.findall("tag")
+                    if tag.get("k") in tags_to_get}
+
+            data[obj.tag].append([obj.tag, obj.get("id"), obj_lat, obj_lng]
+                                 + [tags.get(tag) for tag in tag_list])
+
+    df_osm = pd.DataFrame(data["node"] + data["way"] + data["relation"],
+                          columns=["osm_obj", "osm_id", "osm_lat", "osm_lng"]
+                                  + ["osm_" + tag for tag in tag_list])
     df_osm.drop_duplicates("osm_ref:FR:prix-carburants", inplace=True)
 
     superseded_df = pd.read_csv(config.SUPERSEDED_CSV, encoding="utf-8",
                                 dtype=str)
-    list_dep_id = superseded_df['id'].tolist()
-    list_stations_id = df_osm['osm_ref:FR:prix-carburants'].tolist()
-    new_stations = []
-
-    for i, row in df_osm.iterrows():
-        station_id = row['osm_ref:FR:prix-carburants']
-        if station_id in list_dep_id:
-            superseded_id = superseded_df.iloc[list_dep_id.index(station_id)]['superseded_by']
-            if superseded_id not in list_stations_id:
-                row_new = row
-                row_new['osm_ref:FR:prix-carburants'] = superseded_id
-                new_stations.append(row_new)
-
-    osm_new = pd.DataFrame(new_stations, columns=df_osm.columns)
+    superseded_by = superseded_df.drop_duplicates('id') \
+                                 .set_index('id')['superseded_by']
+
+    # add a copy of the stations whose id is superseded by an id
+    # which is not in OSM yet
+    station_ids = df_osm['osm_ref:FR:prix-carburants']
+    new_ids = station_ids.map(superseded_by)
+    to_add = new_ids.notna() & ~new_ids.isin(set(station_ids.dropna()))
+
+    osm_new = df_osm[to_add].copy()
+    osm_new['osm_ref:FR:prix-carburants'] = new_ids[to_add]
     df_osm = pd.concat((df_osm, osm_new))
 
     df_osm.to_csv(config.OSM_CSV, index=False, 
                   quoting=csv.QUOTE_NONNUMERIC, encoding="utf-8")
 
-def refresh_gas_df():
-
+def last_complete_tables(data_folder, gas_names):
+    """Return the date of the most recent set of binary tables with every gas,
+    or None if there is none.
+    """
+    dates = set(file[:12] for file in os.listdir(data_folder) if file[:12].isdigit())
+    complete = [date for date in dates
+                if all(os.path.isdir(data_folder + "/" + date + "_" + gas_name
+                                     + columnar.TABLE_EXT)
+                       for gas_name in gas_names)]
+    return max(complete) if complete else None
+
+def current_table(data_folder, base_update, gas_name, runs):
+    """Return the table of a gas written at base_update with the deltas of runs applied."""
+    table = data_folder + "/" + base_update + "_" + gas_name
+    df = columnar.read_table(table + columnar.TABLE_EXT, mmap=False)
+    for run in runs:
+        df = columnar.apply_delta(df, columnar.read_table(columnar.delta_path(table, run),
+                                                          mmap=False))
+    return df
+
+def refresh_gas_df(incremental=config.INCREMENTAL_REFRESH):
+    """Download the prices and write the tables of every gas.
+
+    In incremental mode, the new table of each gas is compared by station
+    to the current one, the last full set of tables with the deltas of the
+    following runs applied, and only the rows added, updated (a new price
+    and maj for instance) or removed are written, to a delta table of each
+    gas. The deltas are the changelog of the prices, and SnapshotStore
+    applies them to the loaded snapshots.
+    A full set of tables is written instead on the first run of the day,
+    as the opening hours are the ones of the current day, and when the
+    deltas since the last full set exceed config.INCREMENTAL_MAX_DELTA of
+    its rows. Its columns identical to the ones of the previous set are
+    hard linked.
+    """
     gas_dict = config.GAS_DICT
     day_dict = config.DAY_DICT
     data_folder = config.DATA_FOLDER
 
     
-    with requests.get(config.INSTANT_DATA_URL) as fetch_url:
-        download_time = datetime.datetime.now().strftime("%Y%m%d%H%M")
-        with zipfile.ZipFile(io.BytesIO(fetch_url.content)) as zf:
-            xml_file = zipfile.ZipFile.namelist(zf)[0]
-            with zf.open(xml_file) as xml_file:
-                parsed_xml = ET.parse(xml_file)
-
     ids = []
-    opening_info = []
-    gas_prices = []
+    is_closed_day = {day_name: [] for day_name in day_dict.values()}
+    business_hours = {day_name: [] for day_name in day_dict.values()}
+    gas_price = {gas_name: array('d') for gas_name in gas_dict.values()}
+    gas_last_update = {gas_name: [] for gas_name in gas_dict.values()}
 
-    opening_info_cols = pd.MultiIndex.from_product(
-                          [['is_closed_day', 'business_hours'],
-                          list(day_dict.values())])
-    gas_cols = pd.MultiIndex.from_product([['gas_price', 'gas_last_update'], 
-                                          list(gas_dict.values())])
+    download_time = datetime.datetime.now().strftime("%Y%m%d%H%M")
 
+    with open_zipped_xml(config.INSTANT_DATA_URL) as xml_file:
+        for pdv in iter_elements(xml_file, ('pdv',)):
+            ids.append(pdv.get('id'))
 
-    for pdv in parsed_xml.getroot().findall('pdv'):
-        ids.append(pdv.get('id'))
-        opening_info_to_append = [[False for i in day_dict], 
-                                  [None for i in day_dict]]
-        
-        
-        horaires_node = pdv.find('horaires')
-        if horaires_node is not None:
-            for jour in horaires_node.findall('jour'):
-                opening_info_to_append[0][int(jour.get('id')) - 1] \
-                    = bool(jour.get('ferme'))
-                openings_day = []
-                closings_day = []
-                
-                for horaire in jour.findall('horaire'):
-                    openings_day.append(
-                        horaire.get('ouverture').replace(".", ":")
-                    )
-                    closings_day.append(
-                        horaire.get('fermeture').replace(".", ":")
-                    )
-                
-                    if (openings_day is not None \
-                     and closings_day is not None \
-                     and len(openings_day) == len(closings_day)):
+            pdv_closed_day = {}
+            pdv_business_hours = {}
+
+            horaires_node = pdv.find('horaires')
+            if horaires_node is not None:
+                for jour in horaires_node.findall('jour'):
+                    day_name = day_dict[int(jour.get('id'))]
+                    pdv_closed_day[day_name] = bool(jour.get('ferme'))
+
+                    openings_day = []
+                    closings_day = []
+                    for horaire in jour.findall('horaire'):
+                        openings_day.append(
+                            horaire.get('ouverture').replace(".", ":")
+                        )
+                        closings_day.append(
+                            horaire.get('fermeture').replace(".", ":")
+                        )
+
+                    if openings_day:
                         openings_day.sort()
                         closings_day.sort()
-                        hours_to_join = [f"{opening}-{closing}" 
-                                         for index, (opening, closing)
-                                         in enumerate(zip(openings_day, closings_day))]
-                        opening_info_to_append[1][int(jour.get('id')) - 1] \
-                            = ("|").join(hours_to_join)
-        
-        opening_info.append(
-            [item for sublist in opening_info_to_append for item in sublist]
-        )
-        
-        gas_to_append = [[None for i in gas_dict] 
-                         for j
-                         in ['gas price', 'last update']]
-
-        for gas in pdv.findall('prix'):
-            gas_to_append_index = int(gas.get('id')) - 1
-            gas_to_append[0][gas_to_append_index] = float(gas.get('valeur'))
-            gas_to_append[1][gas_to_append_index] \
-                = datetime.datetime.strptime(
-                    gas.get('maj'), "%Y-%m-%d %H:%M:%S"
-                )
-
-        gas_prices.append(
-            [item for sublist in gas_to_append for item in sublist]
-        )
-        
-    df_general_info = pd.read_csv(config.STATIONS_CSV, encoding="utf-8",
-                                  dtype={"id": str})
-    df_general_info = df_general_info[df_general_info['id'].isin(ids)]
-    df_general_info.columns = pd.MultiIndex.from_product(
-                                  [df_general_info.columns, [""]]
-                              )
-
-    df_opening_info = pd.DataFrame(opening_info, 
-                                   columns=opening_info_cols,
-                                   index=ids)
-    df_gas_prices = pd.DataFrame(gas_prices, 
-                                 columns=gas_cols,
-                                 index=ids)
-
-    df = pd.concat([df_opening_info, df_gas_prices], axis=1)
-    df = pd.merge(df_general_info, df, how='right', right_index=True, left_on='id')
-
-    brand = pd.read_csv(config.BRAND_CSV, encoding="utf-8",
-                                    dtype={"Identifiant": str})
-    brand_cols = pd.MultiIndex.from_product([brand.columns, [""]])
-    brand.columns = brand_cols
-
-    df = pd.merge(brand, df, how='right', 
-                  left_on='Identifiant',
-                  right_on='id')
+                        pdv_business_hours[day_name] = ("|").join(
+                            [f"{opening}-{closing}"
+                             for opening, closing
+                             in zip(openings_day, closings_day)]
+                        )
 
-    osm = pd.read_csv(config.OSM_CSV, encoding="utf-8",
-                      dtype={"osm_ref:FR:prix-carburants": str})
-    osm_cols = pd.MultiIndex.from_product([osm.columns, [""]])
-    osm.columns = osm_cols
-
-    df = pd.merge(osm, df, how='right', 
-                  left_on='osm_ref:FR:prix-carburants', 
-                  right_on='id')
-
-    latitude = []
-    longitude = []
-    for i in df.index:
-        if df.loc[i, ('osm_id', "")] is not None:
-            latitude.append(df.loc[i, ('osm_lat', "")])
-            longitude.append(df.loc[i, ('osm_lng', "")])
-        elif df.loc[i, ('match', "")] == True:
-            latitude.append(df.loc[i, ('result_lat', "")])
-            longitude.append(df.loc[i, ('result_lng', "")])
-        else:
-            latitude.append(df.loc[i, ('lat', "")])
-            longitude.append(df.loc[i, ('lng', "")])
+            for day_name in day_dict.values():
+                is_closed_day[day_name].append(pdv_closed_day.get(day_name, False))
+                business_hours[day_name].append(pdv_business_hours.get(day_name))
 
-    df[('latitude', "")] = latitude
-    df[('longitude', "")] = longitude
+            pdv_prices = {}
+            for gas in pdv.findall('prix'):
+                pdv_prices[gas_dict[int(gas.get('id'))]] = (gas.get('valeur'),
+                                                            gas.get('maj'))
 
-    cols_to_keep = ['id', 'Nom', 'Marque', 'address', 'latitude', 'longitude',
-                    'services', 'automate_h24', 'is_closed_day', 'business_hours',
-                    'gas_price', 'gas_last_update']
+            for gas_name in gas_dict.values():
+                price, last_update = pdv_prices.get(gas_name, (None, None))
+                gas_price[gas_name].append(float(price) if price else np.nan)
+                gas_last_update[gas_name].append(last_update)
 
-    df = df.xs(cols_to_keep, axis=1)
+    base_update = None
+    if incremental:
+        base_update = last_complete_tables(data_folder, gas_dict.values())
 
-    today_id = datetime.datetime.today().weekday() + 1
-    days_cols_to_drop = [day_name 
-                         for day_id, day_name
-                         in day_dict.items()
-                         if day_id != today_id]
-    df_day = df.drop(labels=days_cols_to_drop, level=1, axis=1)
+    today_name = day_dict[datetime.datetime.today().weekday() + 1]
 
+    df = pd.DataFrame({'id': ids,
+                       'is_closed_day': np.array(is_closed_day[today_name], dtype=bool),
+                       'business_hours': business_hours[today_name]})
 
-    for gas_to_save in gas_dict.values():
-        gas_cols_to_drop = [gas_name
-                            for gas_name
-                            in gas_dict.values()
-                            if gas_name != gas_to_save]
-        
-        df_filtered = df_day.drop(labels=gas_cols_to_drop, level=1, axis=1)
-        df_filtered.columns = df_filtered.columns.droplevel(1)
-
-        min_price = df_filtered.describe()['gas_price'].loc['25%'] * 0.8
-        max_price = df_filtered.describe()['gas_price'].loc['75%'] * 1.5
-
-        df_filtered = df_filtered[(df_filtered['gas_price'] > min_price) &
-                                  (df_filtered['gas_price'] < max_price)]
-        
-        df_filtered = df_filtered[df_filtered['gas_last_update']
-                        .apply(lambda x: (datetime.datetime.today() - x).days) < 45]
+    df_general_info = pd.read_csv(config.STATIONS_CSV, encoding="utf-8",
+                                  dtype={"id": str},
+                                  usecols=['id', 'lat', 'lng', 'address',
+                                           'services', 'automate_h24'])
+    df = df.merge(df_general_info.drop_duplicates('id'), how='left', on='id')
 
-        df_filtered = df_filtered[(~df_filtered['is_closed_day']) |
-                                  (df_filtered['automate_h24'])]
-        
-        csv_file_name = download_time + "_" + gas_to_save
-        csv_path = data_folder + "/" + csv_file_name + ".csv"
-        df_filtered.to_csv(csv_path, index=False,
-                           encoding="utf-8", quoting=csv.QUOTE_NONNUMERIC)
+    brand = pd.read_csv(config.BRAND_CSV, encoding="utf-8",
+                        dtype={"Identifiant": str})
+    brand = brand.drop_duplicates('Identifiant') \
+                 .rename(columns={'Identifiant': 'id'})
+    df = df.merge(brand, how='left', on='id')
 
+    osm = pd.read_csv(config.OSM_CSV, encoding="utf-8",
+                      dtype={"osm_ref:FR:prix-carburants": str},
+                      usecols=['osm_id', 'osm_lat', 'osm_lng',
+                               'osm_ref:FR:prix-carburants'])
+    osm = osm.drop_duplicates('osm_ref:FR:prix-carburants') \
+             .rename(columns={'osm_ref:FR:prix-carburants': 'id'})
+    df = df.merge(osm, how='left', on='id')
+
+    ban = pd.read_csv(config.BAN_ADDRESSES_CSV, encoding="utf-8")
+    df = df.merge(ban.drop_duplicates('address'), how='left', on='address')
+
+    # coordinates from OSM first, then from the BAN geocoding when the
+    # address matched, then the ones of the gas price feed
+    use_osm = df['osm_id'].notna().values
+    use_ban = (df['match'] == True).values
+    df['latitude'] = np.select([use_osm, use_ban],
+                               [df['osm_lat'].values, df['result_lat'].values],
+                               default=df['lat'].values)
+    df['longitude'] = np.select([use_osm, use_ban],
+                                [df['osm_lng'].values, df['result_lng'].values],
+                                default=df['lng'].values)
+
+    df['automate_h24'] = df['automate_h24'].fillna(False).astype(bool)
+
+    # filter the prices of every gas at once
+    prices = pd.DataFrame({gas_name: np.frombuffer(column)
+                           for gas_name, column in gas_price.items()})
+    last_updates = pd.DataFrame({gas_name: pd.to_datetime(column,
+                                                          format="%Y-%m-%d %H:%M:%S")
+                                 for gas_name, column in gas_last_update.items()})
+
+    quartiles = prices.quantile([0.25, 0.75])
+    is_open = (~df['is_closed_day'] | df['automate_h24']).values
+    to_save = ((prices > quartiles.loc[0.25] * 0.8)
+               & (prices < quartiles.loc[0.75] * 1.5)
+               & (datetime.datetime.today() - last_updates < pd.Timedelta(days=45))
+               & is_open[:, None])
 
+    cols_to_keep = ['id', 'Nom', 'Marque', 'address', 'latitude', 'longitude',
+                    'services', 'automate_h24', 'is_closed_day', 'business_hours']
 
-    files_list = os.listdir(data_folder)
+    tables = {}
+    for gas_to_save in gas_dict.values():
+        rows = to_save[gas_to_save].values
+        df_filtered = df.loc[rows, cols_to_keep]
+        df_filtered['gas_price'] = prices[gas_to_save].values[rows]
+        df_filtered['gas_last_update'] = last_updates[gas_to_save].values[rows]
+        tables[gas_to_save] = df_filtered
+
+    deltas = {}
+    if base_update is not None and base_update[:8] == download_time[:8]:
+        runs = columnar.delta_runs(data_folder, base_update, gas_dict.values())
+        for gas_to_save, df_filtered in tables.items():
+            if not df_filtered['id'].is_unique:
+                break
+            table = data_folder + "/" + base_update + "_" + gas_to_save
+            nb_rows = len(columnar.read_column(table + columnar.TABLE_EXT, 'id'))
+            nb_delta_rows = sum(len(columnar.read_column(columnar.delta_path(table, run), 'id'))
+                                for run in runs)
+            delta = columnar.diff_tables(
+                current_table(data_folder, base_update, gas_to_save, runs), df_filtered)
+            if nb_delta_rows + len(delta) > config.INCREMENTAL_MAX_DELTA * nb_rows:
+                break
+            deltas[gas_to_save] = delta
+        else:
+            # a run is complete once the deltas of every gas are written
+            if any(len(delta) for delta in deltas.values()):
+                for gas_to_save, delta in deltas.items():
+                    table = data_folder + "/" + base_update + "_" + gas_to_save
+                    columnar.write_table(delta, columnar.delta_path(table, download_time))
+            return
+
+    for gas_to_save, df_filtered in tables.items():
+        file_name = download_time + "_" + gas_to_save
+
+        previous_path = None
+        if base_update is not None:
+            previous_path = data_folder + "/" + base_update + "_" + gas_to_save
+
+        # the binary table is read by the web app, the csv file is kept
+        # for debugging. Both are written to a temporary file first so
+        # that readers never load a partially written file
+        written = columnar.write_table(
+            df_filtered,
+            data_folder + "/" + file_name + columnar.TABLE_EXT,
+            previous=previous_path + columnar.TABLE_EXT if previous_path else None
+        )
 
-    files_date = []
-    gas_files = []
+        csv_path = data_folder + "/" + file_name + ".csv"
+        if previous_path and not written and os.path.exists(previous_path + ".csv"):
+            columnar.link_or_copy(previous_path + ".csv", csv_path + ".tmp")
+        else:
+            df_filtered.to_csv(csv_path + ".tmp", index=False,
+                               encoding="utf-8", quoting=csv.QUOTE_NONNUMERIC)
+        os.replace(csv_path + ".tmp", csv_path)
 
-    for file in files_list:
-        if file[:12].isdigit():
-            files_date.append(int(file[:12]))
-            gas_files.append(file)
+    files_date = set([int(file[:12])
+                      for file in os.listdir(data_folder)
+                      if file[:12].isdigit()
+                      and file.endswith((".csv", columnar.TABLE_EXT))])
 
     # remove the oldest files from the folder
     # keep the last 2 set of files
-    if len(files_date) > 2 * len(gas_dict):
-        date_of_files_to_remove = min(files_date)
-        for file in gas_files:
-            if int(file[:12]) == date_of_files_to_remove:
-                os.remove(data_folder + "/" + file)
+    if len(files_date) > 2:
+        date_of_files_to_remove = str(min(files_date))
+        for file in os.listdir(data_folder):
+            if file[:12] == date_of_files_to_remove:
+                file_path = data_folder + "/" + file
+                if os.path.isdir(file_path):
+                    shutil.rmtree(file_path)
+                else:
+                    os.remove(file_path)
 
 def refresh_brand_csv():
     import math
@@ -479,5 +625,6 @@ if __name__ == "__main__":
     #refresh_BAN()
     #refresh_superseded()
     #refresh_osm_xml()
+    #refresh_road_graph()
     #refresh_osm_df()
     refresh_gas_df()
\ No newline at end of file
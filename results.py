@@ -1,142 +1,193 @@
-from functions.url import unshorten_url, extract_directions, encode_url
-from functions.data import MapsRoute, get_last_update
-from functions import config
+from functions.url import unshorten_url, unshorten_url_async, extract_directions, encode_url
+from functions.data import MapsRoute, SnapshotStore, get_directions_client
+from functions.cache import LRUCache
+from functions import config, metrics
 from functions.geo import *
+import numpy as np
 import pandas as pd
 import re
+import asyncio
+import contextlib
+import datetime
+import functools
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-def get_results(
-    input_url,
-    gas,
-    consumption_per_100km,
-    liters_to_fill_up, 
-    trade_off, 
-    km_start = 0, 
-    km_end = 200
-):
+snapshot_store = SnapshotStore(config.DATA_FOLDER)
+detour_executor = ThreadPoolExecutor(max_workers=config.DETOUR_WORKERS)
+batch_executor = ThreadPoolExecutor(max_workers=config.BATCH_WORKERS)
+scoring_executor = ThreadPoolExecutor(max_workers=config.SCORING_WORKERS)
+_scoring_pool = None
+_scoring_pool_lock = threading.Lock()
+result_cache = LRUCache(maxsize=config.RESULT_CACHE_SIZE, ttl=config.RESULT_CACHE_TTL)
+_result_cache_update = None
 
-    gas_dict = config.GAS_DICT
-    data_folder = config.DATA_FOLDER
+REGEX_LAT_LNG = r"^(\d*\.)?\d+,(\d*\.)?\d+$"
 
-    gas_chosen = gas_dict[int(gas)]
-    gas_consumption = consumption_per_100km / 100000
-    trade_off_fn = trade_off / (15 * 60)
+TRADE_OFF_COLUMNS = ['detour_distance', 'detour_duration', 'detour_speed',
+                     'revised_detour_cost', 'revised_trade_off_cost', 'output_url']
+RESULT_COLUMNS = ['id', 'Nom', 'Marque', 'address', 'latitude', 'longitude',
+                  'gas_price', 'gas_last_update', 'automate_h24',
+                  'fill_up_cost', 'min_detour_dist', 'min_trade_off_cost',
+                  'detour_distance', 'detour_duration', 'detour_speed',
+                  'revised_detour_cost', 'revised_trade_off_cost', 'output_url']
+COORDINATE_COLUMNS = ['latitude', 'longitude']
+DEFAULT_RESULT_COLUMNS = ['id', 'gas_price', 'detour_distance', 'detour_duration',
+                          'revised_trade_off_cost', 'output_url']
 
-    regex_lat_lng = "^(\d*\.)?\d+,(\d*\.)?\d+$"
+def no_timer(stage):
+    return contextlib.nullcontext()
 
-    if re.match(regex_lat_lng, input_url):
-        origin = input_url
-        waypoints = []
-        destination = origin
-        alternative_route = 0
-    else:
-        url = unshorten_url(input_url)
-        origin, waypoints, destination, alternative_route = extract_directions(url)
-
-    route = MapsRoute(
-        origin=origin, 
-        waypoints=waypoints,
-        destination=destination,
-        alternative_route=alternative_route,
-        km_start=km_start,
-        km_end=km_end
-    )
-
-    route.get_section_coord()
-    route.get_full_smoothed_route()
-    route.transform_coord_to_smoothed()
-    route.get_bounds()
-    route.extend_bounds()
-
-    last_update = get_last_update(data_folder)
-
-    csv_name = data_folder + "/" + last_update + "_" + gas_chosen + ".csv"
-
-    df_filtered = pd.read_csv(csv_name)
-
-    df_filtered = df_filtered[(df_filtered['latitude'] < route.NE_lat) & 
-                              (df_filtered['latitude'] > route.SW_lat) & 
-                              (df_filtered['longitude'] < route.NE_lng) &
-                              (df_filtered['longitude'] > route.SW_lng)]
-
-    dist_mat = pd.DataFrame(distance_matrix(route.lat,
-                                            route.lng,
-                                            df_filtered['latitude'].tolist(),
-                                            df_filtered['longitude'].tolist()),
-                            index=df_filtered.index)
-
-    dist_mat['closest_pt'] = dist_mat.idxmin(axis=1)
-    dist_mat['latitude'] = df_filtered['latitude']
-    dist_mat['longitude'] = df_filtered['longitude']
-
-    df_filtered['fill_up_cost'] = df_filtered['gas_price'] * liters_to_fill_up
-
-    min_detour_dist =[]
-    for index, row in dist_mat.iterrows():
-        if len(route.lat) > 1 and len(route.lng) > 1:
-            i = int(row['closest_pt'])
-            if i == 0:
-                dist_to_prev_seg = np.inf
-            else:
-                dist_to_prev_seg = point_to_line_segment(row['latitude'],
-                                                         row['longitude'],
-                                                         route.lat[i - 1],
-                                                         route.lng[i - 1],
-                                                         route.lat[i],
-                                                         route.lng[i])
-            if i == len(route.lat) - 1:
-                dist_to_next_seg = np.inf
-            else:
-                dist_to_next_seg = point_to_line_segment(row['latitude'],
-                                                         row['longitude'], 
-                                                         route.lat[i],
-                                                         route.lng[i],
-                                                         route.lat[i + 1],
-                                                         route.lng[i + 1])
-
-            min_detour_dist.append(2 * min(dist_to_prev_seg, dist_to_next_seg))
+def directions_client():
+    """Return the directions client, the local backend locates the stations
+    of the detours in the snapshots.
+    """
+    return get_directions_client(places=snapshot_store.find_place)
+
+def scoring_pool():
+    """Return the process pool matching the stations of the long routes."""
+    global _scoring_pool
+    with _scoring_pool_lock:
+        if _scoring_pool is None:
+            # spawn, the parent process runs threads
+            _scoring_pool = ProcessPoolExecutor(max_workers=config.SCORING_PROCESSES
+                                                or os.cpu_count(),
+                                                mp_context=multiprocessing.get_context("spawn"))
+        return _scoring_pool
+
+def parse_input(input_url):
+    """Return origin, waypoints, destination, alternative_route of a url or a point.
+
+    For a point, waypoints is None and no directions request is needed.
+    """
+    if re.match(REGEX_LAT_LNG, input_url):
+        return input_url, None, input_url, 0
+    url = unshorten_url(input_url)
+    return extract_directions(url)
+
+async def parse_input_async(input_url):
+    """Same as parse_input, without blocking the event loop."""
+    if re.match(REGEX_LAT_LNG, input_url):
+        return input_url, None, input_url, 0
+    url = await unshorten_url_async(input_url)
+    return extract_directions(url)
+
+def get_route(origin, waypoints, destination, alternative_route,
+              km_start=0, km_end=200, timer=no_timer):
+    """Return the simplified MapsRoute of the section km_start..km_end."""
+    with timer("directions"):
+        route = MapsRoute(
+            origin=origin, 
+            waypoints=waypoints,
+            destination=destination,
+            alternative_route=alternative_route,
+            km_start=km_start,
+            km_end=km_end,
+            client=directions_client()
+        )
+
+    with timer("section_coord"):
+        route.get_section_coord()
+
+    with timer("smoothing"):
+        route.simplify()
+
+    return route
+
+def match_stations(route, snapshot, timer=no_timer):
+    """Return the positions in snapshot.df of the stations near the route
+    and their distance to it in m.
+
+    Above config.PARALLEL_SCORING_CELLS route points times candidates, the
+    route is matched by sections on the processes of scoring_pool.
+    """
+    dist_to_check = config.DIST_TO_CHECK * 1000
+
+    with timer("corridor_filter"):
+        candidates = snapshot.grid.candidates(route.lat, route.lng, dist_to_check)
+
+    with timer("distance_matrix"):
+        if (len(route.lat) > 1
+                and len(route.lat) * len(candidates) >= config.PARALLEL_SCORING_CELLS):
+            candidates, min_dist = snapshot.parallel_corridor(
+                route.lat, route.lng, dist_to_check, scoring_pool(),
+                config.SCORING_PROCESSES or os.cpu_count())
         else:
-            min_detour_dist.append(2 * exact_distance(row['latitude'],
-                                                      row['longitude'],
-                                                      route.lat[0],
-                                                      route.lng[0]))
+            _, min_dist = route_detours(route.lat,
+                                        route.lng,
+                                        snapshot.grid.lat[candidates],
+                                        snapshot.grid.lng[candidates])
+        in_corridor = min_dist <= dist_to_check
 
-    df_filtered['min_detour_dist'] = min_detour_dist
+    metrics.CORRIDOR_CANDIDATES.observe(int(in_corridor.sum()))
+    metrics.DISTANCE_MATRIX_CELLS.observe(len(route.lat) * len(candidates))
 
-    df_filtered = df_filtered[pd.notna(df_filtered['min_detour_dist'])]
+    return candidates[in_corridor], min_dist[in_corridor]
 
-    df_filtered['min_detour_cost'] = (gas_consumption
-                                      * df_filtered['gas_price']
-                                      * df_filtered['min_detour_dist'])
-    df_filtered['min_detour_duration'] = (df_filtered['min_detour_dist']
-                                          / config.MAX_SPEED)
-    df_filtered['min_trade_off_cost'] = \
-        (df_filtered['fill_up_cost']
-         + df_filtered['min_detour_cost']
-         + df_filtered['min_detour_duration'] * trade_off_fn)
+def point_stations(route, snapshot, gas_consumption, liters_to_fill_up,
+                   trade_off_fn, timer=no_timer):
+    """Return the positions in snapshot.df of the best stations around
+    a point and their distance to it in m, see Snapshot.cheapest_around.
+    """
+    with timer("corridor_filter"):
+        return snapshot.cheapest_around(route.lat[0], route.lng[0],
+                                        config.DIST_TO_CHECK * 1000,
+                                        liters_to_fill_up, gas_consumption,
+                                        trade_off_fn)
 
-    df_filtered = df_filtered.nsmallest(n=10, columns='min_trade_off_cost')
+def score_stations(snapshot, stations, min_dist, gas_consumption,
+                   liters_to_fill_up, trade_off_fn, timer=no_timer):
+    """Return the 10 stations with the lowest estimated trade off cost."""
+    with timer("scoring"):
+        df_filtered = snapshot.df.iloc[stations].copy()
 
-    df_trade_off = pd.DataFrame(columns=['detour_distance',
-                                         'detour_duration',
-                                         'detour_speed',
-                                         'revised_detour_cost',
-                                         'revised_trade_off_cost',
-                                         'output_url'])
+        df_filtered['fill_up_cost'] = df_filtered['gas_price'] * liters_to_fill_up
+        df_filtered['min_detour_dist'] = 2 * min_dist
 
-    for index, row in df_filtered.iterrows():
+        df_filtered = df_filtered[pd.notna(df_filtered['min_detour_dist'])]
 
+        df_filtered['min_detour_cost'] = (gas_consumption
+                                          * df_filtered['gas_price']
+                                          * df_filtered['min_detour_dist'])
+        df_filtered['min_detour_duration'] = (df_filtered['min_detour_dist']
+                                              / config.MAX_SPEED)
+        df_filtered['min_trade_off_cost'] = \
+            (df_filtered['fill_up_cost']
+             + df_filtered['min_detour_cost']
+             + df_filtered['min_detour_duration'] * trade_off_fn)
 
-        waypoint = (df_filtered['Nom'].loc[index] + ", "
-                    + str(df_filtered['address'].loc[index]))
+        return df_filtered.nsmallest(n=10, columns='min_trade_off_cost')
 
-        result_route = MapsRoute(origin=origin,
+def station_waypoint(df_filtered, index):
+    """Return the waypoint of a station in the detour requests."""
+    return (df_filtered['Nom'].loc[index] + ", "
+            + str(df_filtered['address'].loc[index]))
+
+def refine_stations(route, df_filtered, gas_consumption, trade_off_fn, timer=no_timer):
+    """Return the actual detours of the best stations of df_filtered.
+
+    With config.DETOUR_ENGINE "routes", detours are computed in the order
+    of min_trade_off_cost until one is cheaper than the estimate of every
+    remaining station. With "matrix", the detours of every station are
+    computed at once from distance matrices.
+    """
+    df_trade_off = pd.DataFrame(columns=TRADE_OFF_COLUMNS)
+
+    def get_detour(index):
+        waypoint = station_waypoint(df_filtered, index)
+        result_route = MapsRoute(origin=route.origin,
                                  waypoints=waypoint,
-                                 destination=destination,
-                                 alternative_route=0)
-        
-        detour_distance = result_route.distance - route.distance    
-        detour_duration = result_route.duration - route.duration
+                                 destination=route.destination,
+                                 alternative_route=0,
+                                 client=directions_client())
+        return detour_costs(index, waypoint, result_route.distance, result_route.duration)
+
+    def detour_costs(index, waypoint, distance, duration):
+        detour_distance = distance - route.distance
+        detour_duration = duration - route.duration
         if detour_duration == 0:
             detour_speed = 0
         else:
@@ -150,27 +201,449 @@ def get_results(
                                   + revised_detour_cost
                                   + detour_duration * trade_off_fn)
         
-        output_url = encode_url(origin=result_route.origin,
-                                waypoints=result_route.waypoints,
-                                destination=result_route.destination)
+        output_url = encode_url(origin=route.origin,
+                                waypoints=waypoint,
+                                destination=route.destination)
+
+        return [detour_distance,
+                detour_duration,
+                detour_speed,
+                revised_detour_cost,
+                revised_trade_off_cost,
+                output_url]
+
+    if config.DETOUR_ENGINE == "matrix":
+        # origin -> stations and stations -> destination, the detour
+        # through a station is the sum of its two legs
+        with timer("refinement"):
+            client = directions_client()
+            indexes = df_filtered.index.tolist()
+            waypoints = [station_waypoint(df_filtered, index) for index in indexes]
+            to_stations = detour_executor.submit(client.distance_matrix,
+                                                 [route.origin], waypoints)
+            from_stations = client.distance_matrix(waypoints, [route.destination])
+            to_stations = to_stations.result()[0]
+
+            for index, waypoint, first, second in zip(indexes, waypoints, to_stations,
+                                                      from_stations):
+                if first is not None and second[0] is not None:
+                    df_trade_off.loc[index] = detour_costs(index, waypoint,
+                                                           first[0] + second[0][0],
+                                                           first[1] + second[0][1])
+
+        metrics.REFINEMENT_ROUTES.observe(len(indexes))
+        return df_trade_off
+
+    # The detour routes are fetched concurrently by waves of candidates.
+    # Within a wave, results are applied in the order of min_trade_off_cost
+    # so the search stops at the same candidate as a sequential search,
+    # the remaining routes of the wave are speculative and discarded.
+    with timer("refinement"):
+        to_refine = df_filtered.index.tolist()
+        found = False
+        nb_routes = 0
+        for wave_start in range(0, len(to_refine), config.DETOUR_WAVE_SIZE):
+            wave = to_refine[wave_start:wave_start + config.DETOUR_WAVE_SIZE]
+            nb_routes += len(wave)
+
+            for index, detour in zip(wave, detour_executor.map(get_detour, wave)):
+                df_trade_off.loc[index] = detour
+
+                if min(df_trade_off['revised_trade_off_cost']) \
+                   < df_filtered[~df_filtered.index.isin(df_trade_off.index)]['min_trade_off_cost'].min():
+                    found = True
+                    break
 
-        df_trade_off.loc[index] = [detour_distance,
-                                   detour_duration,
-                                   detour_speed,
-                                   revised_detour_cost,
-                                   revised_trade_off_cost,
-                                   output_url]
+            if found:
+                break
 
-        if min(df_trade_off['revised_trade_off_cost']) \
-           < min(df_filtered[~df_filtered.index.isin(df_trade_off.index)]['min_trade_off_cost']):
-            break
+    metrics.REFINEMENT_ROUTES.observe(nb_routes)
 
+    return df_trade_off
 
-    df_results = pd.concat(
+def profile_params(gas, consumption_per_100km, trade_off):
+    """Return the gas name, the consumption in l/m and the cost of a second."""
+    return (config.GAS_DICT[int(gas)],
+            consumption_per_100km / 100000,
+            trade_off / (15 * 60))
+
+def merge_results(df_filtered, df_trade_off):
+    """Return the scored stations with their detours, best first."""
+    return pd.concat(
         (df_filtered, df_trade_off), join="outer", axis=1
-    ).sort_values(by=['revised_trade_off_cost', 'min_trade_off_cost']) 
+    ).sort_values(by=['revised_trade_off_cost', 'min_trade_off_cost'])
+
+def find_stations(parsed, gas_chosen, gas_consumption, liters_to_fill_up,
+                  trade_off_fn, km_start=0, km_end=200, timer=no_timer):
+    """Return the route of parsed, see parse_input, and its scored stations."""
+    origin, waypoints, destination, alternative_route = parsed
+    route = get_route(origin, waypoints, destination, alternative_route,
+                      km_start, km_end, timer)
+
+    with timer("snapshot"):
+        snapshot = snapshot_store.get(gas_chosen)
+
+    if waypoints is None:
+        stations, min_dist = point_stations(route, snapshot, gas_consumption,
+                                            liters_to_fill_up, trade_off_fn, timer)
+    else:
+        stations, min_dist = match_stations(route, snapshot, timer)
+    df_filtered = score_stations(snapshot, stations, min_dist, gas_consumption,
+                                 liters_to_fill_up, trade_off_fn, timer)
+    return route, df_filtered
+
+def result_key(parsed, gas_chosen, consumption_per_100km, liters_to_fill_up,
+               trade_off, km_start, km_end, refine):
+    """Return the key of a query in result_cache.
+
+    The key holds the parsed route, the parameters and the date of the
+    current set of snapshots. The cache is cleared when a new set is
+    swapped in.
+    """
+    global _result_cache_update
+    snapshot_store.get(gas_chosen)
+    last_update = snapshot_store.last_update
+    if last_update != _result_cache_update:
+        result_cache.clear()
+        _result_cache_update = last_update
+
+    origin, waypoints, destination, alternative_route = parsed
+    return json.dumps([origin, waypoints, destination, alternative_route, gas_chosen,
+                       float(consumption_per_100km), float(liters_to_fill_up),
+                       float(trade_off), float(km_start), float(km_end),
+                       bool(refine), last_update],
+                      ensure_ascii=False)
+
+def compute_stations(
+    input_url,
+    gas,
+    consumption_per_100km,
+    liters_to_fill_up, 
+    trade_off, 
+    km_start = 0, 
+    km_end = 200,
+    refine = True,
+    timer = no_timer
+):
+    """Return the scored stations and the detours of the best ones
+    for a route or a point, see get_results.
+
+    Around a point, only the stations which can beat the best estimates
+    are scored. The detours are not computed if refine is False.
+    The results are kept in result_cache, and must not be modified.
+    """
+    gas_chosen, gas_consumption, trade_off_fn = \
+        profile_params(gas, consumption_per_100km, trade_off)
+
+    with timer("parse_url"):
+        parsed = parse_input(input_url)
+
+    key = result_key(parsed, gas_chosen, consumption_per_100km, liters_to_fill_up,
+                     trade_off, km_start, km_end, refine)
+    cached = result_cache.get(key)
+    if cached is not None:
+        metrics.RESULT_CACHE.labels(result="hit").inc()
+        return cached
+    metrics.RESULT_CACHE.labels(result="miss").inc()
+
+    route, df_filtered = find_stations(parsed, gas_chosen, gas_consumption,
+                                       liters_to_fill_up, trade_off_fn,
+                                       km_start, km_end, timer)
+    if refine:
+        df_trade_off = refine_stations(route, df_filtered, gas_consumption,
+                                       trade_off_fn, timer)
+    else:
+        df_trade_off = pd.DataFrame(columns=TRADE_OFF_COLUMNS)
+
+    result_cache.set(key, (df_filtered, df_trade_off))
+    return df_filtered, df_trade_off
+
+async def compute_stations_async(
+    input_url,
+    gas,
+    consumption_per_100km,
+    liters_to_fill_up, 
+    trade_off, 
+    km_start = 0, 
+    km_end = 200,
+    refine = True,
+    timer = no_timer
+):
+    """Same as compute_stations, without blocking the event loop.
+
+    The url and the directions are fetched with non-blocking requests and
+    stored in the caches, then the scoring runs on scoring_executor, where
+    MapsRoute reads the directions from the cache. The first wave of
+    detours is fetched the same way, the "matrix" detours and the next
+    waves are fetched from scoring_executor.
+    """
+    gas_chosen, gas_consumption, trade_off_fn = \
+        profile_params(gas, consumption_per_100km, trade_off)
+    loop = asyncio.get_running_loop()
+    # the local backend loads its road graph on first use
+    client = await loop.run_in_executor(scoring_executor, directions_client)
+
+    with timer("parse_url"):
+        parsed = await parse_input_async(input_url)
+
+    key = await loop.run_in_executor(
+        scoring_executor, result_key, parsed, gas_chosen, consumption_per_100km,
+        liters_to_fill_up, trade_off, km_start, km_end, refine)
+    cached = result_cache.get(key)
+    if cached is not None:
+        metrics.RESULT_CACHE.labels(result="hit").inc()
+        return cached
+    metrics.RESULT_CACHE.labels(result="miss").inc()
+
+    origin, waypoints, destination, alternative_route = parsed
+    if waypoints is not None:
+        await client.directions_async(origin=origin,
+                                      waypoints=waypoints,
+                                      destination=destination,
+                                      alternatives=(alternative_route > 0))
+
+    route, df_filtered = await loop.run_in_executor(
+        scoring_executor, functools.partial(find_stations, parsed, gas_chosen,
+                                            gas_consumption, liters_to_fill_up,
+                                            trade_off_fn, km_start, km_end, timer))
+    if not refine:
+        df_trade_off = pd.DataFrame(columns=TRADE_OFF_COLUMNS)
+        result_cache.set(key, (df_filtered, df_trade_off))
+        return df_filtered, df_trade_off
+
+    if config.DETOUR_ENGINE == "routes":
+        wave = df_filtered.index[:config.DETOUR_WAVE_SIZE]
+        await asyncio.gather(*[client.directions_async(origin=route.origin,
+                                                       waypoints=station_waypoint(df_filtered,
+                                                                                  index),
+                                                       destination=route.destination)
+                               for index in wave])
+
+    df_trade_off = await loop.run_in_executor(
+        scoring_executor, refine_stations, route, df_filtered, gas_consumption,
+        trade_off_fn, timer)
+    result_cache.set(key, (df_filtered, df_trade_off))
+    return df_filtered, df_trade_off
+
+def get_results(
+    input_url,
+    gas,
+    consumption_per_100km,
+    liters_to_fill_up, 
+    trade_off, 
+    km_start = 0, 
+    km_end = 200,
+    refine = True,
+    timer = no_timer
+):
+    """Return the html table of the best stations for a route or a point.
+
+    timer is called with the name of each stage of the computation and
+    must return a context manager, it is used to time the stages.
+    """
+    df_filtered, df_trade_off = compute_stations(input_url, gas, consumption_per_100km,
+                                                 liters_to_fill_up, trade_off,
+                                                 km_start, km_end, refine, timer)
+
+    return results_html(df_filtered, df_trade_off, timer)
+
+async def get_results_async(
+    input_url,
+    gas,
+    consumption_per_100km,
+    liters_to_fill_up, 
+    trade_off, 
+    km_start = 0, 
+    km_end = 200,
+    refine = True,
+    timer = no_timer
+):
+    """Same as get_results, without blocking the event loop."""
+    df_filtered, df_trade_off = await compute_stations_async(
+        input_url, gas, consumption_per_100km, liters_to_fill_up, trade_off,
+        km_start, km_end, refine, timer)
+
+    return await asyncio.get_running_loop().run_in_executor(
+        scoring_executor, results_html, df_filtered, df_trade_off, timer)
+
+def results_html(df_filtered, df_trade_off, timer=no_timer):
+    """Return the html table of the stations, best first."""
+    with timer("render"):
+        df_results = merge_results(df_filtered, df_trade_off)
+
+        with pd.option_context('display.max_colwidth', None):
+            return df_results.to_html()
+
+def _json_value(value):
+    if value is None or value is pd.NaT or (isinstance(value, float) and value != value):
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+def results_table(df_filtered, df_trade_off, columns=DEFAULT_RESULT_COLUMNS):
+    """Return the stations as {"columns": [...], "stations": [[...], ...]}, best first.
+
+    Values are read from df_filtered and df_trade_off without merging them,
+    the detour columns of stations without detour are None. Dates are in
+    ISO 8601 format and coordinates are rounded to 6 decimals.
+    """
+    unknown = [column for column in columns if column not in RESULT_COLUMNS]
+    if unknown:
+        raise ValueError("Unknown columns: " + ", ".join(unknown))
+
+    refined = df_trade_off.index.get_indexer(df_filtered.index)
+    revised_cost = np.full(len(df_filtered), np.nan)
+    revised_cost[refined >= 0] = \
+        df_trade_off['revised_trade_off_cost'].to_numpy(dtype=float)[refined[refined >= 0]]
+    order = np.lexsort((df_filtered['min_trade_off_cost'].to_numpy(dtype=float),
+                        revised_cost))
+
+    values = []
+    for column in columns:
+        if column in df_trade_off.columns:
+            source = df_trade_off[column].to_numpy()
+            column_values = [source[refined[i]] if refined[i] >= 0 else None
+                             for i in order]
+        elif column in COORDINATE_COLUMNS:
+            # float32 in the binary tables
+            column_values = np.round(df_filtered[column].to_numpy(dtype=float)[order],
+                                     6).tolist()
+        else:
+            column_values = df_filtered[column].to_numpy()[order].tolist()
+        values.append([_json_value(value) for value in column_values])
+
+    return {"columns": list(columns),
+            "stations": [list(row) for row in zip(*values)]}
+
+def get_results_json(
+    input_url,
+    gas,
+    consumption_per_100km,
+    liters_to_fill_up, 
+    trade_off, 
+    km_start = 0, 
+    km_end = 200,
+    columns = DEFAULT_RESULT_COLUMNS,
+    refine = True,
+    timer = no_timer
+):
+    """Return the best stations for a route or a point as a dict
+    serializable to JSON, see results_table.
+    """
+    df_filtered, df_trade_off = compute_stations(input_url, gas, consumption_per_100km,
+                                                 liters_to_fill_up, trade_off,
+                                                 km_start, km_end, refine, timer)
+
+    with timer("render"):
+        return results_table(df_filtered, df_trade_off, columns)
+
+async def get_results_json_async(
+    input_url,
+    gas,
+    consumption_per_100km,
+    liters_to_fill_up, 
+    trade_off, 
+    km_start = 0, 
+    km_end = 200,
+    columns = DEFAULT_RESULT_COLUMNS,
+    refine = True,
+    timer = no_timer
+):
+    """Same as get_results_json, without blocking the event loop."""
+    df_filtered, df_trade_off = await compute_stations_async(
+        input_url, gas, consumption_per_100km, liters_to_fill_up, trade_off,
+        km_start, km_end, refine, timer)
+
+    def render():
+        with timer("render"):
+            return results_table(df_filtered, df_trade_off, columns)
+
+    return await asyncio.get_running_loop().run_in_executor(scoring_executor, render)
+
+def get_batch_results(queries, timer=no_timer):
+    """Return the best stations for many routes and user profiles at once.
+
+    queries is a list of dicts of the arguments of get_results (without
+    timer). Queries are grouped so that each url is expanded once, each
+    route (url and km_start..km_end) is fetched once and its stations are
+    matched once per gas, all queries use the same set of snapshots.
+
+    Return a list of dicts, in the order of the queries, with the keys
+    "results" (the DataFrame of the stations, best first, None on error)
+    and "error" (the exception type and message, None on success).
+    """
+    queries = [dict({"km_start": 0, "km_end": 200, "refine": True}, **query)
+               for query in queries]
+
+    with timer("parse_url"):
+        parsed = {url: batch_executor.submit(parse_input, url)
+                  for url in {query['input_url'] for query in queries}}
+
+    # Tasks only wait for tasks submitted before them, so the executor
+    # cannot be starved by waiting tasks.
+    routes = {}
+    snapshots = {}
+    matches = {}
+
+    def match_route(key, gas_chosen):
+        return match_stations(routes[key].result(), snapshots[gas_chosen], timer)
+
+    def get_query_results(query, key, gas_chosen):
+        _, gas_consumption, trade_off_fn = \
+            profile_params(query['gas'], query['consumption_per_100km'],
+                           query['trade_off'])
+        route = routes[key].result()
+        if (key, gas_chosen) in matches:
+            stations, min_dist = matches[(key, gas_chosen)].result()
+        else:
+            stations, min_dist = point_stations(route, snapshots[gas_chosen],
+                                                gas_consumption,
+                                                query['liters_to_fill_up'],
+                                                trade_off_fn, timer)
+
+        df_filtered = score_stations(snapshots[gas_chosen], stations, min_dist,
+                                     gas_consumption, query['liters_to_fill_up'],
+                                     trade_off_fn, timer)
+        if query['refine']:
+            df_trade_off = refine_stations(route, df_filtered, gas_consumption,
+                                           trade_off_fn, timer)
+        else:
+            df_trade_off = pd.DataFrame(columns=TRADE_OFF_COLUMNS)
+        return merge_results(df_filtered, df_trade_off)
+
+    futures = []
+    for query in queries:
+        try:
+            gas_chosen = config.GAS_DICT[int(query['gas'])]
+            origin, waypoints, destination, alternative_route = \
+                parsed[query['input_url']].result()
+        except Exception as e:
+            futures.append(e)
+            continue
 
-    with pd.option_context('display.max_colwidth', -1):
-        return df_results.to_html()
+        key = (origin, None if waypoints is None else tuple(waypoints), destination,
+               alternative_route, query['km_start'], query['km_end'])
+        if key not in routes:
+            routes[key] = batch_executor.submit(
+                get_route, origin, waypoints, destination, alternative_route,
+                query['km_start'], query['km_end'], timer)
+        if gas_chosen not in snapshots:
+            with timer("snapshot"):
+                snapshots[gas_chosen] = snapshot_store.get(gas_chosen)
+        if waypoints is not None and (key, gas_chosen) not in matches:
+            matches[(key, gas_chosen)] = batch_executor.submit(match_route, key, gas_chosen)
+        futures.append(batch_executor.submit(get_query_results, query, key, gas_chosen))
 
-        
\ No newline at end of file
+    batch_results = []
+    for future in futures:
+        try:
+            if isinstance(future, Exception):
+                raise future
+            batch_results.append({"results": future.result(), "error": None})
+        except Exception as e:
+            batch_results.append({"results": None,
+                                  "error": type(e).__name__ + ": " + str(e)})
+    return batch_results
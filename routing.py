@@ -0,0 +1,390 @@
+import os
+import re
+import shutil
+from array import array
+import numpy as np
+import polyline
+try:
+    from .geo import exact_distance_arr, simplify_route, StationGrid
+    from .xmlstream import iter_elements
+except ImportError:
+    # refresh_csv is run as a script, next to routing.py
+    from geo import exact_distance_arr, simplify_route, StationGrid
+    from xmlstream import iter_elements
+
+# Local stand-in for the Google Maps directions API.
+# Routes are computed with Dijkstra searches over a road graph built from an OSM extract
+# and returned in the structure of the directions API responses (legs,
+# steps, overview_polyline), so MapsRoute uses them unchanged.
+
+# speed in km/h by highway tag, the other ways are not routable
+HIGHWAY_SPEEDS = {
+    'motorway': 120, 'motorway_link': 60,
+    'trunk': 100, 'trunk_link': 50,
+    'primary': 80, 'primary_link': 40,
+    'secondary': 70, 'secondary_link': 40,
+    'tertiary': 60, 'tertiary_link': 30,
+    'unclassified': 50, 'residential': 30,
+    'living_street': 10, 'service': 20,
+}
+
+REGEX_LAT_LNG = re.compile(r"^\s*(-?\d*\.?\d+)\s*,\s*(-?\d*\.?\d+)\s*$")
+
+
+class RoadGraph:
+    """Directed road graph in compressed sparse row format.
+
+    The edges leaving node i are indices[indptr[i]:indptr[i + 1]], with
+    their length in m and their duration in s. The graph is searched with
+    scipy.sparse.csgraph directly on these arrays, which are
+    memory-mapped when the graph is loaded from disk.
+    """
+
+    def __init__(self, lat, lng, indptr, indices, length, duration):
+        self.lat = np.asarray(lat, dtype=float)
+        self.lng = np.asarray(lng, dtype=float)
+        # the index type of scipy.sparse.csgraph, used without a copy
+        self.indptr = np.asarray(indptr, dtype=np.int32)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.length = np.asarray(length, dtype=float)
+        self.duration = np.asarray(duration, dtype=float)
+
+        # fastest speed of the graph in m/s, to bound the searches
+        with np.errstate(divide='ignore', invalid='ignore'):
+            speeds = self.length / self.duration
+        self.max_speed = float(np.nanmax(speeds)) if len(speeds) else 1.
+        # no path is longer, a search with this bound is unbounded
+        self._total_duration = float(self.duration.sum())
+
+        self._grid = None
+        self._matrices = {}
+
+    def __len__(self):
+        return len(self.lat)
+
+    @classmethod
+    def from_edges(cls, lat, lng, source, target, length, duration):
+        order = np.argsort(source, kind='stable')
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(source, minlength=len(lat)))))
+        return cls(lat, lng, indptr, np.asarray(target)[order],
+                   np.asarray(length)[order], np.asarray(duration)[order])
+
+    @classmethod
+    def from_osm_xml(cls, xml_path, speeds=HIGHWAY_SPEEDS, chunk_size=1 << 16):
+        """Build the graph of the routable ways of an OSM xml extract.
+
+        The file is streamed twice, for the ways then for their nodes, and
+        the node refs of the ways are kept in flat arrays, so the memory
+        used is about the size of the graph.
+        """
+        refs = array('q')
+        way_sizes = array('q')
+        way_speeds = array('d')
+        way_reversed = array('b')
+        way_two_way = array('b')
+        for way in iter_elements(xml_path, ('way',)):
+            tags = {tag.get('k'): tag.get('v') for tag in way.iter('tag')}
+            if tags.get('highway') in speeds:
+                nb_refs = len(refs)
+                refs.extend(int(nd.get('ref')) for nd in way.iter('nd'))
+                way_sizes.append(len(refs) - nb_refs)
+                way_speeds.append(speeds[tags['highway']] / 3.6)
+                oneway = tags.get('oneway', 'no')
+                way_reversed.append(oneway == '-1')
+                way_two_way.append(oneway not in ('yes', 'true', '1', '-1')
+                                   and tags.get('junction') != 'roundabout')
+
+        refs = np.frombuffer(refs, dtype=np.int64)
+        node_ids = np.unique(refs)
+
+        # the nodes are filtered by chunks, most of them are not on a way
+        ids, lat, lng = [], [], []
+        chunk_ids, chunk_lat, chunk_lng = array('q'), array('d'), array('d')
+
+        def flush():
+            chunk = np.array(chunk_ids, dtype=np.int64)
+            pos = np.minimum(np.searchsorted(node_ids, chunk), len(node_ids) - 1)
+            keep = node_ids[pos] == chunk
+            ids.append(chunk[keep])
+            lat.append(np.array(chunk_lat)[keep])
+            lng.append(np.array(chunk_lng)[keep])
+            del chunk_ids[:], chunk_lat[:], chunk_lng[:]
+
+        if len(node_ids):
+            for node in iter_elements(xml_path, ('node',)):
+                chunk_ids.append(int(node.get('id')))
+                chunk_lat.append(float(node.get('lat')))
+                chunk_lng.append(float(node.get('lon')))
+                if len(chunk_ids) == chunk_size:
+                    flush()
+            flush()
+        ids = np.concatenate(ids) if ids else np.array([], dtype=np.int64)
+        lat = np.concatenate(lat) if lat else np.array([])
+        lng = np.concatenate(lng) if lng else np.array([])
+
+        # node index of each ref, the refs missing from the extract are skipped
+        order = np.argsort(ids, kind='stable')
+        pos = np.minimum(np.searchsorted(ids[order], refs), max(len(ids) - 1, 0))
+        found = ids[order][pos] == refs if len(ids) else np.zeros(len(refs), dtype=bool)
+        nodes = order[pos][found]
+        node_way = np.repeat(np.arange(len(way_sizes)),
+                             np.frombuffer(way_sizes, dtype=np.int64))[found]
+
+        # consecutive nodes of a way, in both directions for two-way roads
+        pairs = np.flatnonzero(node_way[:-1] == node_way[1:])
+        first = nodes[pairs]
+        second = nodes[pairs + 1]
+        edge_way = node_way[pairs]
+        reverse = np.frombuffer(way_reversed, dtype=np.int8).astype(bool)[edge_way]
+        first, second = np.where(reverse, second, first), np.where(reverse, first, second)
+        two_way = np.frombuffer(way_two_way, dtype=np.int8).astype(bool)[edge_way]
+
+        source = np.concatenate((first, second[two_way]))
+        target = np.concatenate((second, first[two_way]))
+        edge_way = np.concatenate((edge_way, edge_way[two_way]))
+        # edges ordered by way, forward edges first
+        backward = np.arange(len(source)) >= len(first)
+        order = np.lexsort((np.arange(len(source)), backward, edge_way))
+        source, target, edge_way = source[order], target[order], edge_way[order]
+
+        length = exact_distance_arr(lat[source], lng[source], lat[target], lng[target])
+        speed = np.frombuffer(way_speeds)[edge_way]
+        return cls.from_edges(lat, lng, source, target, length, length / speed)
+
+    arrays = ('lat', 'lng', 'indptr', 'indices', 'length', 'duration')
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load a graph saved by save, memory-mapped by default."""
+        return cls(**{name: np.load(os.path.join(path, name + ".npy"),
+                                    mmap_mode="r" if mmap else None,
+                                    allow_pickle=False)
+                      for name in cls.arrays})
+
+    def save(self, path):
+        """Save the graph to the folder path, one .npy file by array.
+
+        As with columnar.write_table, the folder is written under a
+        temporary name then renamed.
+        """
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for name in self.arrays:
+            np.save(os.path.join(tmp_path, name + ".npy"), getattr(self, name),
+                    allow_pickle=False)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+
+    def nearest_node(self, lat, lng, max_dist=50000):
+        """Return the index of the node closest to a point."""
+        if self._grid is None:
+            self._grid = StationGrid(self.lat, self.lng, cell_size=1000)
+
+        dist = 1000
+        while dist <= max_dist:
+            nodes = self._grid.candidates([lat], [lng], dist)
+            if len(nodes):
+                return int(nodes[np.argmin(exact_distance_arr(self.lat[nodes],
+                                                              self.lng[nodes],
+                                                              lat, lng))])
+            dist *= 4
+        raise ValueError(f"No road within {max_dist} m of {lat},{lng}")
+
+    def _matrix(self, reverse=False):
+        """Return the edge durations as a scipy sparse matrix, transposed with reverse."""
+        if reverse not in self._matrices:
+            from scipy.sparse import csr_matrix
+            matrix = csr_matrix((self.duration, self.indices, self.indptr),
+                                shape=(len(self), len(self)))
+            self._matrices[reverse] = matrix.T.tocsr() if reverse else matrix
+        return self._matrices[reverse]
+
+    def _search(self, source, targets, reverse=False):
+        """Return the durations and predecessors of a Dijkstra search from source.
+
+        The search is bounded in duration, from twice the time to reach the
+        farthest target in a straight line at max_speed, and the bound is
+        doubled until every target is reached or the search is unbounded.
+        """
+        from scipy.sparse.csgraph import dijkstra
+        straight = exact_distance_arr(self.lat[targets], self.lng[targets],
+                                      self.lat[source], self.lng[source])
+        limit = max(2 * float(np.max(straight)) / self.max_speed, 600.)
+        while True:
+            if limit >= self._total_duration:
+                limit = np.inf
+            times, predecessors = dijkstra(self._matrix(reverse), indices=source,
+                                           return_predecessors=True, limit=limit)
+            if limit == np.inf or np.isfinite(times[targets]).all():
+                return times, predecessors
+            limit *= 2
+
+    @staticmethod
+    def _walk(predecessors, start, end):
+        """Return the nodes from start to end following the predecessors."""
+        nodes = [start]
+        while nodes[-1] != end:
+            nodes.append(int(predecessors[nodes[-1]]))
+        return nodes
+
+    def _path_edges(self, nodes):
+        """Return the fastest edge between each pair of consecutive nodes."""
+        if len(nodes) < 2:
+            return np.array([], dtype=np.int64)
+        nodes = np.asarray(nodes, dtype=np.int64)
+        first = self.indptr[nodes[:-1]].astype(np.int64)
+        degree = self.indptr[nodes[:-1] + 1] - first
+        pair = np.repeat(np.arange(len(first)), degree)
+        edges = first[pair] + np.arange(len(pair)) - np.repeat(np.cumsum(degree) - degree, degree)
+        match = self.indices[edges] == nodes[1:][pair]
+        pair, edges = pair[match], edges[match]
+        order = np.lexsort((self.duration[edges], pair))
+        pair, edges = pair[order], edges[order]
+        return edges[np.concatenate(([True], pair[1:] != pair[:-1]))]
+
+    def shortest_path(self, source, target):
+        """Return the nodes and edges of the fastest path."""
+        times, predecessors = self._search(source, [target])
+        if not np.isfinite(times[target]):
+            raise ValueError("No route between nodes {} and {}".format(source, target))
+        nodes = self._walk(predecessors, target, source)[::-1]
+        return nodes, self._path_edges(nodes)
+
+    def fastest_to_many(self, source, targets, reverse=False):
+        """Return the (duration, length) of the fastest paths from source to targets.
+
+        A single Dijkstra search reaches every target, unreachable targets
+        are missing from the returned dict. With reverse, the paths go from
+        the targets to source.
+        """
+        targets = list(set(targets))
+        if not targets:
+            return {}
+        times, predecessors = self._search(source, targets, reverse)
+
+        found = {}
+        for target in targets:
+            if np.isfinite(times[target]):
+                # the predecessors of the reverse search lead to source
+                nodes = self._walk(predecessors, target, source)
+                edges = self._path_edges(nodes if reverse else nodes[::-1])
+                found[target] = (float(times[target]), float(self.length[edges].sum()))
+        return found
+
+
+class LocalDirectionsClient:
+    """Directions client computing the routes on a RoadGraph.
+
+    Points are "lat,lng" strings, or names resolved to (lat, lng) by
+    places, a callable returning None for unknown names (the stations
+    waypoints of the detours for instance). Addresses cannot be geocoded.
+    """
+
+    nodes_by_step = 50
+    overview_tolerance = 10
+
+    def __init__(self, graph, places=None):
+        self.graph = graph
+        self.places = places
+
+    def _coord(self, point):
+        match = REGEX_LAT_LNG.match(point)
+        if match:
+            return float(match.group(1)), float(match.group(2))
+        coord = self.places(point) if self.places is not None else None
+        if coord is None:
+            raise ValueError("The local routing backend cannot locate " + point)
+        return coord
+
+    def _leg(self, start, end):
+        graph = self.graph
+        nodes, edges = graph.shortest_path(graph.nearest_node(*start),
+                                           graph.nearest_node(*end))
+        lat = graph.lat[nodes]
+        lng = graph.lng[nodes]
+        length = graph.length[edges]
+        duration = graph.duration[edges]
+
+        steps = []
+        for first in range(0, max(len(nodes) - 1, 1), self.nodes_by_step):
+            last = min(first + self.nodes_by_step, len(nodes) - 1)
+            steps.append({
+                "polyline": {"points": polyline.encode(list(zip(lat[first:last + 1],
+                                                                lng[first:last + 1])))},
+                "end_location": {"lat": float(lat[last]), "lng": float(lng[last])},
+                "distance": {"value": int(round(length[first:last].sum()))},
+                "duration": {"value": int(round(duration[first:last].sum()))}
+            })
+
+        leg = {"start_location": {"lat": float(lat[0]), "lng": float(lng[0])},
+               "end_location": {"lat": float(lat[-1]), "lng": float(lng[-1])},
+               "distance": {"value": int(round(length.sum()))},
+               "duration": {"value": int(round(duration.sum()))},
+               "steps": steps}
+        return leg, lat, lng
+
+    def directions(self, origin, destination, waypoints=None, alternatives=False):
+        if alternatives:
+            raise ValueError("Alternative routes are not available with the local "
+                             "routing backend")
+        if waypoints is None:
+            waypoints = []
+        elif isinstance(waypoints, str):
+            waypoints = [waypoints]
+
+        points = [self._coord(pt) for pt in [origin] + list(waypoints) + [destination]]
+        legs = []
+        route_lat = []
+        route_lng = []
+        for start, end in zip(points[:-1], points[1:]):
+            leg, lat, lng = self._leg(start, end)
+            legs.append(leg)
+            route_lat.append(lat)
+            route_lng.append(lng)
+
+        route_lat = np.concatenate(route_lat)
+        route_lng = np.concatenate(route_lng)
+        keep = simplify_route(route_lat, route_lng, self.overview_tolerance)
+        overview = polyline.encode(list(zip(route_lat[keep], route_lng[keep])))
+
+        return [{"legs": legs, "overview_polyline": {"points": overview}}]
+
+    def distance_matrix(self, origins, destinations):
+        """Return the durations and distances between every origin and destination.
+
+        One search is made from each origin, or backwards from each
+        destination if there are fewer destinations.
+        """
+        graph = self.graph
+        origin_nodes = [graph.nearest_node(*self._coord(pt)) for pt in origins]
+        destination_nodes = [graph.nearest_node(*self._coord(pt)) for pt in destinations]
+
+        paths = {}
+        if len(origin_nodes) <= len(destination_nodes):
+            for source in set(origin_nodes):
+                for target, path in graph.fastest_to_many(source, destination_nodes).items():
+                    paths[source, target] = path
+        else:
+            for target in set(destination_nodes):
+                for source, path in graph.fastest_to_many(target, origin_nodes,
+                                                          reverse=True).items():
+                    paths[source, target] = path
+
+        rows = []
+        for source in origin_nodes:
+            elements = []
+            for target in destination_nodes:
+                if (source, target) in paths:
+                    time, dist = paths[source, target]
+                    elements.append({"status": "OK",
+                                     "distance": {"value": int(round(dist))},
+                                     "duration": {"value": int(round(time))}})
+                else:
+                    elements.append({"status": "ZERO_RESULTS"})
+            rows.append({"elements": elements})
+
+        return {"status": "OK",
+                "origin_addresses": list(origins),
+                "destination_addresses": list(destinations),
+                "rows": rows}
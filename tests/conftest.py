@@ -0,0 +1,32 @@
+import os
+import re
+import sys
+import types
+
+# The modules import each other as the functions package, and view.py
+# imports results as a top-level module, so both must be importable
+# from the repository folder.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+if "functions" not in sys.modules:
+    package = types.ModuleType("functions")
+    package.__path__ = [ROOT]
+    sys.modules["functions"] = package
+
+# config.py ships without its Google API key, which is not valid Python:
+# load it with the key from the environment, or a placeholder.
+if "functions.config" not in sys.modules:
+    config_path = os.path.join(ROOT, "config.py")
+    with open(config_path, encoding="utf-8") as f:
+        source = f.read()
+    key = os.environ.get("GOOGLE_API_KEY", "AIza-test-key")
+    source = re.sub(r"^GOOGLE_API_KEY\s*=\s*$", "GOOGLE_API_KEY = " + repr(key),
+                    source, count=1, flags=re.M)
+    config = types.ModuleType("functions.config")
+    config.__file__ = config_path
+    exec(compile(source, config_path, "exec"), config.__dict__)
+    sys.modules["functions.config"] = config
+    # refresh_csv.py and the fallback imports of the shared modules
+    # import config as a top-level module
+    sys.modules.setdefault("config", config)
+    sys.modules["functions"].config = config
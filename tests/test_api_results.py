@@ -0,0 +1,55 @@
+import json
+import numpy as np
+import pandas as pd
+import results
+import view
+from functions.columnar import write_table
+from functions.data import Snapshot
+
+
+def binary_snapshot(tmp_path):
+    df = pd.DataFrame({
+        "id": ["75001001", "75001002", "75001003"],
+        "Nom": ["Station A", "Station B", "Station C"],
+        "Marque": ["Total", "Esso", None],
+        "address": ["1 rue A 75001 PARIS", "2 rue B 75001 PARIS", "3 rue C 75001 PARIS"],
+        "latitude": [48.8592, 48.8601, 48.8613],
+        "longitude": [2.3417, 2.3429, 2.3441],
+        "services": ["Automate CB", None, "Automate CB"],
+        "automate_h24": [True, False, True],
+        "is_closed_day": [False, False, True],
+        "business_hours": [None, None, None],
+        "gas_price": [1.459, 1.479, 1.439],
+        "gas_last_update": pd.to_datetime(["2018-11-16 10:00:00", "2018-11-16 11:30:00",
+                                           None]),
+    })
+    path = str(tmp_path / "201811170104_Gazole.cols")
+    write_table(df, path)
+    return Snapshot.from_table(path, "201811170104")
+
+
+def test_api_results_every_column(tmp_path, monkeypatch):
+    snapshot = binary_snapshot(tmp_path)
+    df_filtered = results.score_stations(snapshot, np.arange(3), np.array([100., 250., 400.]),
+                                         6.5 / 100000, 40, 5 / (15 * 60))
+    df_trade_off = pd.DataFrame([[210, 30, 7., 0.02, 58.4, "https://www.google.com/maps/dir/"]],
+                                index=df_filtered.index[:1],
+                                columns=results.TRADE_OFF_COLUMNS)
+    monkeypatch.setattr(results, "compute_stations",
+                        lambda *args, **kwargs: (df_filtered, df_trade_off))
+
+    response = view.app.test_client().post("/api/results", data={
+        "maps_url": "48.86,2.34", "gas": "1", "consumption": "6.5", "liters": "40",
+        "trade_off": "5", "columns": ",".join(results.RESULT_COLUMNS)})
+
+    assert response.status_code == 200
+    payload = json.loads(response.data)
+    assert payload["columns"] == results.RESULT_COLUMNS
+    assert len(payload["stations"]) == 3
+    stations = [dict(zip(payload["columns"], row)) for row in payload["stations"]]
+    by_id = {station["id"]: station for station in stations}
+    assert by_id["75001001"]["gas_last_update"] == "2018-11-16T10:00:00"
+    assert by_id["75001003"]["gas_last_update"] is None
+    assert by_id["75001002"]["latitude"] == 48.8601
+    assert by_id["75001002"]["longitude"] == 2.3429
+    assert stations[0]["detour_distance"] == 210
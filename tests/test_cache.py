@@ -0,0 +1,73 @@
+import types
+import pytest
+from functions import cache
+from functions.cache import LRUCache, SqliteCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.]
+    monkeypatch.setattr(cache, "time", types.SimpleNamespace(time=lambda: now[0]))
+    return now
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_cache(request, tmp_path):
+    def make(maxsize, ttl=None):
+        if request.param == "memory":
+            return LRUCache(maxsize=maxsize, ttl=ttl)
+        return SqliteCache(str(tmp_path / "cache.sqlite"), maxsize=maxsize, ttl=ttl)
+    return make
+
+
+def test_get_missing_key(make_cache):
+    entries = make_cache(2)
+    assert entries.get("a") is None
+    assert entries.get("a", "default") == "default"
+
+
+def test_ttl(make_cache, clock):
+    entries = make_cache(10, ttl=60)
+    entries.set("a", [1, 2])
+    clock[0] += 60
+    assert entries.get("a") == [1, 2]
+    clock[0] += 1
+    assert entries.get("a") is None
+    assert len(entries) == 0
+
+
+def test_no_ttl(make_cache, clock):
+    entries = make_cache(10)
+    entries.set("a", 1)
+    clock[0] += 10 ** 9
+    assert entries.get("a") == 1
+
+
+def test_evicts_least_recently_used(make_cache, clock):
+    entries = make_cache(2)
+    entries.set("a", 1)
+    clock[0] += 1
+    entries.set("b", 2)
+    clock[0] += 1
+    assert entries.get("a") == 1
+    clock[0] += 1
+    entries.set("c", 3)
+    assert len(entries) == 2
+    assert entries.get("b") is None
+    assert entries.get("a") == 1
+    assert entries.get("c") == 3
+
+
+def test_clear(make_cache):
+    entries = make_cache(2)
+    entries.set("a", 1)
+    entries.clear()
+    assert len(entries) == 0
+    assert entries.get("a") is None
+
+
+def test_sqlite_cache_is_shared(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    SqliteCache(path, table="unshorten").set("https://goo.gl/maps/x", "https://www.google.com/maps/dir/a/b")
+    assert SqliteCache(path, table="unshorten").get("https://goo.gl/maps/x") == \
+        "https://www.google.com/maps/dir/a/b"
@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+from functions.columnar import (write_table, read_table, diff_tables, apply_delta,
+                                delta_path, delta_runs, TABLE_EXT)
+from functions.data import SnapshotStore
+
+
+def prices(ids, price, maj, lat=None):
+    return pd.DataFrame({
+        "id": ids,
+        "Nom": ["Station " + i for i in ids],
+        "Marque": ["Total" if int(i) % 2 else None for i in ids],
+        "latitude": lat if lat is not None else [48.85 + int(i) / 1000 for i in ids],
+        "longitude": [2.35 + int(i) / 1000 for i in ids],
+        "automate_h24": [bool(int(i) % 2) for i in ids],
+        "gas_price": price,
+        "gas_last_update": pd.to_datetime(maj),
+    })
+
+
+def sorted_rows(df):
+    df = df.assign(id=df["id"].astype(str)).sort_values("id").reset_index(drop=True)
+    return df.astype({"Nom": str, "Marque": object}).astype({"latitude": np.float32})
+
+
+def round_trip(tmp_path, name, df):
+    path = str(tmp_path / name)
+    write_table(df, path)
+    return read_table(path)
+
+
+def test_delta_round_trip(tmp_path):
+    old = round_trip(tmp_path, "old" + TABLE_EXT, prices(
+        ["1", "2", "3"], [1.5, 1.6, 1.7],
+        ["2018-11-16 10:00", "2018-11-16 11:00", "2018-11-16 12:00"]))
+    new = prices(["1", "3", "4"], [1.5, 1.65, 1.8],
+                 ["2018-11-16 10:00", "2018-11-17 09:00", "2018-11-17 10:00"])
+
+    delta = round_trip(tmp_path, "delta", diff_tables(old, new))
+
+    assert dict(zip(delta["id"].astype(str), delta["change"].astype(str))) == \
+        {"2": "removed", "3": "updated", "4": "added"}
+    result = apply_delta(old, delta)
+    pd.testing.assert_frame_equal(sorted_rows(result), sorted_rows(new), check_dtype=False)
+
+
+def test_updates_keep_the_rows(tmp_path):
+    old = round_trip(tmp_path, "old" + TABLE_EXT, prices(
+        ["1", "2"], [1.5, 1.6], ["2018-11-16 10:00", "2018-11-16 11:00"]))
+    new = prices(["2", "1"], [1.6, 1.45], ["2018-11-16 11:00", "2018-11-17 08:00"])
+
+    delta = diff_tables(old, new)
+
+    assert len(delta) == 1
+    result = apply_delta(old, delta)
+    assert list(result["id"].astype(str)) == ["1", "2"]
+    assert list(result["gas_price"]) == [1.45, 1.6]
+    assert result["gas_last_update"][0] == pd.Timestamp("2018-11-17 08:00")
+
+
+def test_no_change(tmp_path):
+    df = prices(["1", "2"], [1.5, np.nan], ["2018-11-16 10:00", None])
+    assert len(diff_tables(round_trip(tmp_path, "old" + TABLE_EXT, df), df)) == 0
+
+
+def test_store_applies_the_deltas(tmp_path):
+    base = prices(["1", "2", "3"], [1.5, 1.6, 1.7],
+                  ["2018-11-16 10:00", "2018-11-16 11:00", "2018-11-16 12:00"])
+    table = str(tmp_path / "201811170100_Gazole")
+    write_table(base, table + TABLE_EXT)
+    store = SnapshotStore(str(tmp_path), gas_names=["Gazole"], poll_interval=0)
+    snapshot = store.get("Gazole")
+
+    updated = base.assign(gas_price=[1.5, 1.55, 1.7])
+    write_table(diff_tables(read_table(table + TABLE_EXT), updated),
+                delta_path(table, "201811170110"))
+    assert delta_runs(str(tmp_path), "201811170100", ["Gazole"]) == ["201811170110"]
+
+    assert store.refresh()
+    assert store.last_update == "201811170110"
+    assert list(store.get("Gazole").gas_price) == [1.5, 1.55, 1.7]
+    assert store.get("Gazole").grid is snapshot.grid
+
+    added = pd.concat([updated, prices(["4"], [1.4], ["2018-11-17 01:00"])])
+    write_table(diff_tables(store.get("Gazole").df, added),
+                delta_path(table, "201811170120"))
+    assert store.refresh()
+    assert list(store.get("Gazole").gas_price) == [1.5, 1.55, 1.7, 1.4]
+    assert not store.refresh()
@@ -0,0 +1,102 @@
+import asyncio
+from functions.cache import LRUCache
+from functions.data import CachedDirectionsClient
+
+
+class StubClient:
+    """Offline stand-in of googlemaps.Client recording its requests."""
+
+    def __init__(self, unreachable=()):
+        self.directions_calls = []
+        self.matrix_calls = []
+        self.unreachable = set(unreachable)
+
+    def directions(self, origin, destination, waypoints=None, alternatives=False):
+        self.directions_calls.append((origin, destination, waypoints, alternatives))
+        return [{"summary": origin + " -> " + destination}]
+
+    def distance_matrix(self, origins, destinations):
+        self.matrix_calls.append((list(origins), list(destinations)))
+        rows = []
+        for origin in origins:
+            elements = []
+            for destination in destinations:
+                if (origin, destination) in self.unreachable:
+                    elements.append({"status": "ZERO_RESULTS"})
+                else:
+                    elements.append({"status": "OK",
+                                     "distance": {"value": 1000 * origin + destination},
+                                     "duration": {"value": origin + destination}})
+            rows.append({"elements": elements})
+        return {"status": "OK", "rows": rows}
+
+
+def test_directions_cache_hit_and_miss():
+    stub = StubClient()
+    client = CachedDirectionsClient(stub, LRUCache())
+
+    first = client.directions("Paris", "Lyon")
+    assert client.directions("Paris", "Lyon") == first
+    assert len(stub.directions_calls) == 1
+
+    client.directions("Paris", "Lyon", alternatives=True)
+    client.directions("Paris", "Lyon", waypoints=["Dijon"])
+    assert len(stub.directions_calls) == 3
+
+
+def test_directions_async_shares_the_cache():
+    stub = StubClient()
+    client = CachedDirectionsClient(stub, LRUCache())
+
+    first = asyncio.run(client.directions_async("Paris", "Lyon"))
+    assert client.directions("Paris", "Lyon") == first
+    assert len(stub.directions_calls) == 1
+
+
+def check_limits(stub):
+    for origins, destinations in stub.matrix_calls:
+        assert len(origins) <= CachedDirectionsClient.matrix_max_points
+        assert len(destinations) <= CachedDirectionsClient.matrix_max_points
+        assert len(origins) * len(destinations) <= CachedDirectionsClient.matrix_max_elements
+
+
+def requested_pairs(stub):
+    return [(origin, destination)
+            for origins, destinations in stub.matrix_calls
+            for origin in origins for destination in destinations]
+
+
+def test_distance_matrix_chunks():
+    stub = StubClient()
+    client = CachedDirectionsClient(stub, LRUCache())
+    origins, destinations = list(range(30)), list(range(100, 108))
+
+    matrix = client.distance_matrix(origins, destinations)
+
+    check_limits(stub)
+    assert sorted(requested_pairs(stub)) == [(o, d) for o in origins for d in destinations]
+    assert len(stub.matrix_calls) == 3
+    assert matrix[29][7] == (29107, 136)
+
+
+def test_distance_matrix_many_destinations():
+    stub = StubClient()
+    client = CachedDirectionsClient(stub, LRUCache())
+
+    matrix = client.distance_matrix([1], list(range(60)))
+
+    check_limits(stub)
+    assert [len(destinations) for _, destinations in stub.matrix_calls] == [25, 25, 10]
+    assert matrix[0] == [(1000 + d, 1 + d) for d in range(60)]
+
+
+def test_distance_matrix_requests_missing_elements_only():
+    stub = StubClient(unreachable=[(2, 11)])
+    client = CachedDirectionsClient(stub, LRUCache())
+
+    client.distance_matrix([1, 2], [10, 11])
+    matrix = client.distance_matrix([1, 2], [10, 11, 12])
+
+    assert stub.matrix_calls[1:] == [([1, 2], [12])]
+    assert matrix == [[(1010, 11), (1011, 12), (1012, 13)],
+                      [(2010, 12), None, (2012, 14)]]
@@ -0,0 +1,73 @@
+import http.server
+import threading
+import time
+import pytest
+from functions import config, net
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        state = self.server.state
+        with state["lock"]:
+            state["requests"] += 1
+            state["active"] += 1
+            state["max_active"] = max(state["max_active"], state["active"])
+            failing = self.path == "/flaky" and state["requests"] <= 2
+        if self.path == "/slow":
+            time.sleep(0.2)
+        with state["lock"]:
+            state["active"] -= 1
+        self.send_response(503 if failing else 200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(config, "HTTP_BACKOFF", 0)
+    monkeypatch.setattr(config, "HTTP_BACKOFF_JITTER", 0)
+    monkeypatch.setattr(net, "_host_semaphores", {})
+    net.close()
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    httpd.state = {"lock": threading.Lock(), "requests": 0, "active": 0, "max_active": 0}
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+    net.close()
+
+
+def url(server, path):
+    return "http://127.0.0.1:%d%s" % (server.server_address[1], path)
+
+
+def test_request_retries_unavailable(server, monkeypatch):
+    monkeypatch.setattr(config, "HTTP_RETRIES", 3)
+    response = net.request("GET", url(server, "/flaky"))
+    assert response.status_code == 200
+    assert server.state["requests"] == 3
+
+
+def test_request_returns_last_error(server, monkeypatch):
+    monkeypatch.setattr(config, "HTTP_RETRIES", 1)
+    response = net.request("GET", url(server, "/flaky"))
+    assert response.status_code == 503
+    assert server.state["requests"] == 2
+
+
+def test_request_per_host_limit(server, monkeypatch):
+    monkeypatch.setattr(config, "HTTP_MAX_PER_HOST", 2)
+    statuses = []
+    threads = [threading.Thread(target=lambda: statuses.append(
+                   net.request("GET", url(server, "/slow")).status_code))
+               for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert statuses == [200] * 6
+    assert server.state["max_active"] == 2
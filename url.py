@@ -1,11 +1,67 @@
-import requests
 from urllib.parse import unquote_plus, quote_plus, urlencode
+from . import config, metrics, net
+from .cache import LRUCache, SqliteCache
+
+_unshorten_cache = None
+
+def get_unshorten_cache():
+    """Return the process-wide cache of expanded short urls."""
+    global _unshorten_cache
+    if _unshorten_cache is None:
+        if config.UNSHORTEN_CACHE_DB:
+            _unshorten_cache = SqliteCache(config.UNSHORTEN_CACHE_DB,
+                                           maxsize=config.UNSHORTEN_CACHE_SIZE,
+                                           ttl=config.UNSHORTEN_CACHE_TTL,
+                                           table="unshorten")
+        else:
+            _unshorten_cache = LRUCache(maxsize=config.UNSHORTEN_CACHE_SIZE,
+                                        ttl=config.UNSHORTEN_CACHE_TTL)
+    return _unshorten_cache
 
 def unshorten_url(url):
-    session = requests.Session()  # so connections are recycled
-    resp = session.head(url, allow_redirects=True)
+    """Return the url a short url redirects to.
+
+    Full direction urls are returned as is, and the expanded urls are
+    cached.
+    """
+    if "maps/dir/" in url:
+        metrics.UNSHORTEN_CACHE.labels(result="full_url").inc()
+        return url
+
+    cache = get_unshorten_cache()
+    expanded_url = cache.get(url)
+    if expanded_url is not None:
+        metrics.UNSHORTEN_CACHE.labels(result="hit").inc()
+        return expanded_url
+
+    metrics.UNSHORTEN_CACHE.labels(result="miss").inc()
+    with metrics.UNSHORTEN_SECONDS.time():
+        resp = net.request("HEAD", url, allow_redirects=True)
+    # failed expansions are not cached
+    if "maps/dir/" in resp.url:
+        cache.set(url, resp.url)
     return resp.url
 
+async def unshorten_url_async(url):
+    """Same as unshorten_url, without blocking the event loop."""
+    if "maps/dir/" in url:
+        metrics.UNSHORTEN_CACHE.labels(result="full_url").inc()
+        return url
+
+    cache = get_unshorten_cache()
+    expanded_url = cache.get(url)
+    if expanded_url is not None:
+        metrics.UNSHORTEN_CACHE.labels(result="hit").inc()
+        return expanded_url
+
+    metrics.UNSHORTEN_CACHE.labels(result="miss").inc()
+    with metrics.UNSHORTEN_SECONDS.time():
+        resp = await net.async_request("HEAD", url, follow_redirects=True)
+    expanded_url = str(resp.url)
+    if "maps/dir/" in expanded_url:
+        cache.set(url, expanded_url)
+    return expanded_url
+
 def extract_directions(url):
     """Extract parameters from Google Maps direction URL. 
     
@@ -1,24 +1,84 @@
-from flask import Flask, render_template, request
-from results import get_results
+from flask import Flask, Response, render_template, request
+from results import get_results, get_results_json, DEFAULT_RESULT_COLUMNS
+from functions import metrics
+import gzip
+import json
 
 
 app = Flask(__name__)
 
+def json_body(data):
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode("utf-8")
+
 @app.route('/home/', methods=['GET', 'POST'])
 @app.route('/', methods=['GET', 'POST'])
 def home():
     if request.method == 'POST':
-        return get_results(
-            input_url = request.form['maps_url'],
-            gas = request.form['gas'],
-            consumption_per_100km = float(request.form['consumption']),
-            liters_to_fill_up = float(request.form['liters']),
-            trade_off = float(request.form['trade_off']),
-            km_start = float(request.form['start']),
-            km_end = float(request.form['end'])
-        )
+        try:
+            with metrics.STAGE_SECONDS.labels(stage="total").time():
+                results = get_results(
+                    input_url = request.form['maps_url'],
+                    gas = request.form['gas'],
+                    consumption_per_100km = float(request.form['consumption']),
+                    liters_to_fill_up = float(request.form['liters']),
+                    trade_off = float(request.form['trade_off']),
+                    km_start = float(request.form['start']),
+                    km_end = float(request.form['end']),
+                    timer = metrics.stage_timer
+                )
+        except Exception:
+            metrics.REQUESTS.labels(outcome="error").inc()
+            raise
+        metrics.REQUESTS.labels(outcome="ok").inc()
+        return results
     return render_template("home.html")
 
+@app.route('/api/results', methods=['GET', 'POST'])
+def api_results():
+    """Best stations as JSON, same parameters as the home form.
+
+    columns is an optional comma separated list of result columns, and
+    refine=0 skips the detour requests.
+    The response is gzipped if the client accepts it.
+    """
+    try:
+        columns = request.values.get('columns')
+        columns = columns.split(",") if columns else DEFAULT_RESULT_COLUMNS
+        with metrics.STAGE_SECONDS.labels(stage="total").time():
+            results = get_results_json(
+                input_url = request.values['maps_url'],
+                gas = request.values['gas'],
+                consumption_per_100km = float(request.values['consumption']),
+                liters_to_fill_up = float(request.values['liters']),
+                trade_off = float(request.values['trade_off']),
+                km_start = float(request.values.get('start', 0)),
+                km_end = float(request.values.get('end', 200)),
+                columns = columns,
+                refine = request.values.get('refine', '1') != '0',
+                timer = metrics.stage_timer
+            )
+        body = json_body(results)
+        status = 200
+        metrics.REQUESTS.labels(outcome="ok").inc()
+    except (KeyError, ValueError) as e:
+        body = json_body({"error": type(e).__name__ + ": " + str(e)})
+        status = 400
+        metrics.REQUESTS.labels(outcome="error").inc()
+    except Exception:
+        metrics.REQUESTS.labels(outcome="error").inc()
+        raise
+
+    response = Response(body, status=status, mimetype="application/json")
+    response.vary.add("Accept-Encoding")
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        response.set_data(gzip.compress(body))
+        response.headers["Content-Encoding"] = "gzip"
+    return response
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 @app.route('/contact', methods=['GET', 'POST'])
 def contact():
     if request.method == 'POST':
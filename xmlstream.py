@@ -0,0 +1,25 @@
+import xml.etree.ElementTree as ET
+
+# Streaming parser of large xml files, shared by the refresh script and
+# the road graph builder. It has no package imports so refresh_csv.py can
+# import it when run as a script.
+
+
+def iter_elements(xml_file, tags):
+    """Yield the children of the root with a tag in tags, one at a time.
+
+    The elements are cleared from the tree once processed, so the memory
+    used does not grow with the size of the file.
+    """
+    context = ET.iterparse(xml_file, events=("start", "end"))
+    _, root = next(context)
+    depth = 0
+    for event, elem in context:
+        if event == "start":
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                if elem.tag in tags:
+                    yield elem
+                root.clear()